@@ -0,0 +1,143 @@
+import json
+import statistics
+import time
+from typing import List
+
+import typer
+from langdetect import detect
+from rich.console import Console
+from rich.table import Table
+
+from core.metrics import metrics
+from core.querying import QueryProcessor
+from core.sharding import ShardedQueryProcessor
+
+app = typer.Typer()
+
+# Rich console for output
+console = Console()
+
+# Query processing methods that can be benchmarked
+MODES = {
+    "daat": "query_process_daat",
+    "taat": "query_process_taat",
+    "and": "query_process_and",
+    "or": "query_process_or",
+    "boolean": "query_process_boolean",
+    "saat": "query_process_saat",
+    "tiered": "query_process_tiered",
+}
+
+
+def load_topics(topic_file: str) -> List[str]:
+    with open(topic_file, "r", encoding="utf-8") as f:
+        return [json.loads(line)["query"] for line in f if line.strip()]
+
+
+def detect_language(query: str) -> str:
+    return "english" if detect(query) == "en" else "italian"
+
+
+def percentile(latencies, p):
+    ordered = sorted(latencies)
+    return ordered[min(len(ordered) - 1, int(p / 100 * len(ordered)))]
+
+
+def run_mode(query_processor, mode, queries):
+    process = getattr(query_processor, MODES[mode])
+    latencies = []
+    for query, lang in queries:
+        start_time = time.perf_counter()
+        process(query, lang)
+        latencies.append(time.perf_counter() - start_time)
+    return latencies
+
+
+def run_throughput(query_processor, mode, queries):
+    # Queries per second over the whole workload, as seen by a client. The
+    # shards are kept busy with several queries in flight, a single index
+    # answers them one after the other. Metrics are left out, the queries
+    # were already recorded by run_mode
+    enabled, metrics.enabled = metrics.enabled, False
+    start_time = time.perf_counter()
+    if isinstance(query_processor, ShardedQueryProcessor):
+        for _ in query_processor.search_many(mode, queries):
+            pass
+    else:
+        run_mode(query_processor, mode, queries)
+    elapsed = time.perf_counter() - start_time
+    metrics.enabled = enabled
+    return len(queries) / elapsed
+
+
+@app.command()
+def benchmark(
+    index: str = typer.Option(
+        "./data/index/index_all/index.pkl", help="Path to the index.pkl file"
+    ),
+    topics: str = typer.Option(
+        "./data/topic.jsonl", help="Path to the topic.jsonl workload"
+    ),
+    mode: List[str] = typer.Option(
+        ["daat"], help=f"Query mode to run, one of {list(MODES)}"
+    ),
+    sharded: bool = typer.Option(
+        False, help="The index is a folder of shards built with --shards"
+    ),
+    metrics_file: str = typer.Option(
+        None,
+        help="Collect per-stage metrics and write them, as JSON for a .json "
+        "file and as Prometheus text otherwise",
+    ),
+):
+    """
+    Run the queries of the topics file and report latencies per mode.
+    """
+
+    metrics.enabled = metrics_file is not None
+
+    if sharded:
+        query_processor = ShardedQueryProcessor(index)
+    else:
+        query_processor = QueryProcessor(index)
+    # Load the optional indexes now so they are not timed with a query
+    if "saat" in mode and not sharded:
+        query_processor.get_impact_index()
+    if "tiered" in mode and not sharded:
+        query_processor.get_tier_index()
+    queries = [(q, detect_language(q)) for q in load_topics(topics)]
+
+    table = Table(title=f"[bold yellow]{len(queries)} queries[/bold yellow]")
+    table.add_column("Mode", style="bold green")
+    for column in ["Mean (ms)", "p50 (ms)", "p95 (ms)", "p99 (ms)", "QPS"]:
+        table.add_column(column, justify="right")
+
+    for name in mode:
+        if name not in MODES:
+            raise typer.BadParameter(f"Unknown mode {name}.")
+        latencies = run_mode(query_processor, name, queries)
+        qps = run_throughput(query_processor, name, queries)
+        table.add_row(
+            name,
+            f"{statistics.mean(latencies) * 1000:.3f}",
+            *(f"{percentile(latencies, p) * 1000:.3f}" for p in [50, 95, 99]),  # noqa
+            f"{qps:.1f}",
+        )
+
+    console.print(table)
+
+    if sharded:
+        query_processor.close()
+    elif "tiered" in mode:
+        stats = query_processor.tier_stats
+        console.print(
+            f"Tier 1 fallback: {stats['fallbacks']}/{stats['queries']} "
+            f"queries ({query_processor.fallback_rate():.1%})"
+        )
+
+    if metrics_file is not None:
+        metrics.export(metrics_file)
+
+
+if __name__ == "__main__":
+    app()
@@ -1,17 +1,24 @@
 import shutil
 import time
+from concurrent.futures import ThreadPoolExecutor
 
-import pyfiglet
 import typer
-from langdetect import detect
 from rich.console import Console
-from rich.table import Table
 from rich.text import Text
 
+from core.metrics import metrics
 from core.querying import QueryProcessor
+from core.utils import Preprocessor
 
 input_folder = "./data/index/index_all/index.pkl"
-query_processor = QueryProcessor(input_folder)
+
+# The index is loaded in the background while the banner and the menu are
+# displayed, queries wait for it in get_query_processor()
+index_loader = ThreadPoolExecutor(max_workers=1)
+query_processor_future = None
+
+# Time budget in seconds of a score-at-a-time query
+SAAT_TIME_BUDGET = 0.05
 
 
 app = typer.Typer()
@@ -21,35 +28,75 @@ console = Console()
 
 
 def detect_language(query: str) -> str:
+    from langdetect import detect
+
     return "english" if detect(query) == "en" else "italian"
 
 
+def load_query_processor():
+    query_processor = QueryProcessor(input_folder)
+    # Also load the nltk resources and the language profiles now rather
+    # than on the first query
+    for lang in ["english", "italian"]:
+        Preprocessor.load_language(lang)
+    detect_language("University of Pisa")
+    return query_processor
+
+
+def load_index_in_background():
+    global query_processor_future
+    if query_processor_future is None:
+        query_processor_future = index_loader.submit(load_query_processor)
+
+
+def get_query_processor():
+    load_index_in_background()
+    return query_processor_future.result()
+
+
 def boolean_retrieval_conjunctive(query):
     lang = detect_language(query)
-    query_result = query_processor.query_process_and(query, lang)
+    # AND, OR, NOT and parentheses, terms are joined with AND by default
+    query_result = get_query_processor().query_process_boolean(
+        query, lang, default_op="AND"
+    )
     return query_result
 
 
 def boolean_retrieval_disjunctive(query):
     lang = detect_language(query)
-    query_result = query_processor.query_process_and(query, lang)
+    # AND, OR, NOT and parentheses, terms are joined with OR by default
+    query_result = get_query_processor().query_process_boolean(
+        query, lang, default_op="OR"
+    )
     return query_result
 
 
 def document_at_a_time(query):
     lang = detect_language(query)
-    query_result = query_processor.query_process_daat(query, lang)
+    query_result = get_query_processor().query_process_daat(query, lang)
     return query_result
 
 
 def term_at_a_time(query):
     lang = detect_language(query)
-    query_result = query_processor.query_process_taat(query, lang)
+    query_result = get_query_processor().query_process_taat(query, lang)
+    return query_result
+
+
+def score_at_a_time(query):
+    lang = detect_language(query)
+    # Anytime ranking: return the best results found within the budget
+    query_result = get_query_processor().query_process_saat(
+        query, lang, max_time=SAAT_TIME_BUDGET
+    )
     return query_result
 
 
 def process_query(mode, query):
     """Handles queries based on the selected mode."""
+    # Wait for the background loading, which also initialises langdetect
+    get_query_processor()
     if mode == 1:
         return document_at_a_time(query)
     elif mode == 2:
@@ -58,6 +105,8 @@ def process_query(mode, query):
         return boolean_retrieval_conjunctive(query)
     elif mode == 4:
         return boolean_retrieval_disjunctive(query)
+    elif mode == 5:
+        return score_at_a_time(query)
     else:
         return "[red]Invalid mode.[/red]"
 
@@ -85,6 +134,8 @@ def display_results(results, execution_time):
         f"\n[bold yellow]🔍 {num_results} Results found in {execution_time:.2f} seconds[/bold yellow]\n"  # noqa
     )
 
+    from rich.table import Table
+
     # Create a table with enhanced aesthetics
     table = Table(
         title="[bold yellow]🔎 Search Results[/bold yellow]",
@@ -148,6 +199,8 @@ def get_terminal_width():
 
 
 def display_home():
+    import pyfiglet
+
     terminal_width = get_terminal_width()
     ascii_art = pyfiglet.figlet_format(
         "UNIPI Search Engine", font="slant", width=terminal_width
@@ -167,6 +220,7 @@ def display_search_modes():
     console.print("2. [cyan]Term-at-a-Time[/cyan]\n")
     console.print("3. [blue]Boolean Retrieval (Conjunctive)[/blue]\n")
     console.print("4. [magenta]Boolean Retrieval (Disjunctive)[/magenta]\n")
+    console.print("5. [yellow]Score-at-a-Time (Anytime)[/yellow]\n")
     console.print("0. [red]Exit[/red]\n")
 
     console.print("\n[bold purple]👉 Enter your choice:[/bold purple] ", end="")
@@ -186,6 +240,7 @@ def get_mode_name(mode: int):
         2: "Term-at-a-Time",
         3: "Boolean Retrieval (Conjunctive)",
         4: "Boolean Retrieval (Disjunctive)",
+        5: "Score-at-a-Time (Anytime)",
     }
     return mode_names.get(mode, "Invalid Mode")
 
@@ -200,14 +255,46 @@ def display_current_mode(mode: int):
         "or [bold red]'exit'[/bold red] to quit.\n",
         style="italic yellow",
     )
+    if mode in (3, 4):
+        default_op = "AND" if mode == 3 else "OR"
+        example = "a AND b" if mode == 3 else "(a OR b)"
+        console.print(
+            f"💡 Use AND, OR, NOT and parentheses; terms are joined with "
+            f"{default_op}: 'a b NOT c' means {example} AND NOT c.\n",
+            style="italic yellow",
+        )
+
+
+def display_metrics():
+    console.print(metrics.to_prometheus(), style="cyan", highlight=False)
 
 
 @app.command()
-def search_engine():
+def search_engine(
+    enable_metrics: bool = typer.Option(
+        False, "--metrics", help="Collect per-stage query metrics"
+    ),
+    metrics_file: str = typer.Option(
+        None,
+        help="Write the metrics on exit, as JSON for a .json file and as "
+        "Prometheus text otherwise",
+    ),
+):
     """
     A CLI-based search engine for University of Pisa.
     """
 
+    metrics.enabled = enable_metrics or metrics_file is not None
+    load_index_in_background()
+
+    try:
+        search_loop()
+    finally:
+        if metrics_file is not None:
+            metrics.export(metrics_file)
+
+
+def search_loop():
     display_home()
 
     current_mode = None
@@ -222,7 +309,7 @@ def search_engine():
                 if current_mode == 0:
                     goodbye()
                     break
-                elif current_mode not in [1, 2, 3, 4]:
+                elif current_mode not in [1, 2, 3, 4, 5]:
                     invalid_input()
                     current_mode = None
                     continue
@@ -240,9 +327,16 @@ def search_engine():
             elif query.lower() == "change":
                 current_mode = None
                 break
+            elif query.lower() == "metrics" and metrics.enabled:
+                display_metrics()
             else:
                 start_time = time.time()
-                result = process_query(current_mode, query)
+                try:
+                    result = process_query(current_mode, query)
+                except ValueError as e:
+                    # e.g. the index needed by the mode was not built
+                    console.print(f"\n[bold red]❌ {e}[/bold red]")
+                    continue
                 end_time = time.time()
 
                 execution_time = end_time - start_time
@@ -0,0 +1,328 @@
+import math
+import re
+
+
+class Term:
+    def __init__(self, text):
+        self.text = text
+
+    def __repr__(self):
+        return f"Term({self.text!r})"
+
+
+class And:
+    def __init__(self, children):
+        self.children = children
+
+    def __repr__(self):
+        return f"And({self.children})"
+
+
+class Or:
+    def __init__(self, children):
+        self.children = children
+
+    def __repr__(self):
+        return f"Or({self.children})"
+
+
+class Not:
+    def __init__(self, child):
+        self.child = child
+
+    def __repr__(self):
+        return f"Not({self.child})"
+
+
+class QueryParser:
+    """
+    Parser of boolean queries with AND, OR and NOT (uppercase, so that the
+    words "and", "or", "not" stay plain terms) and parentheses. NOT binds
+    tighter than AND, which binds tighter than OR. Terms written next to
+    each other are joined with default_op. With OR as default, a NOT written
+    next to the other operands of a disjunction (not joined to them by an
+    explicit OR) excludes its documents from the whole disjunction, as a
+    prohibited clause: "exam date NOT 2019" is (exam OR date) AND NOT 2019.
+    """
+
+    TOKENS = re.compile(r"\(|\)|[^\s()]+")
+    OPERATORS = {"AND", "OR", "NOT"}
+
+    def __init__(self, default_op="AND"):
+        if default_op not in ("AND", "OR"):
+            raise ValueError(
+                f"Default operator '{default_op}' is not supported. \
+                    It should be either 'AND' or 'OR'."
+            )
+        self.default_op = default_op
+
+    def parse(self, query: str):
+        self.tokens = self.TOKENS.findall(query)
+        self.pos = 0
+        if not self.tokens:
+            return Or([])
+        node = self.parse_or()
+        if self.pos < len(self.tokens):
+            raise ValueError(
+                f"Unexpected '{self.tokens[self.pos]}' in query '{query}'."
+            )
+        return node
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return None
+
+    def starts_operand(self):
+        token = self.peek()
+        return token is not None and token not in (")", "AND", "OR")
+
+    def parse_or(self):
+        children = [self.parse_and()]
+        explicit = [False]  # Whether each operand follows an explicit OR
+        while True:
+            if self.peek() == "OR":
+                self.pos += 1
+                explicit.append(True)
+            elif self.default_op == "OR" and self.starts_operand():
+                explicit.append(False)
+            else:
+                break
+            children.append(self.parse_and())
+        explicit.append(False)  # Nothing after the last operand
+
+        optional, prohibited = [], []
+        for i, child in enumerate(children):
+            if isinstance(child, Not) and not (explicit[i] or explicit[i + 1]):
+                prohibited.append(child)
+            else:
+                optional.append(child)
+        if not optional:
+            # Only NOTs, e.g. "NOT 2019": nothing to exclude them from
+            optional, prohibited = children, []
+        node = optional[0] if len(optional) == 1 else Or(optional)
+        return And([node] + prohibited) if prohibited else node
+
+    def parse_and(self):
+        children = [self.parse_not()]
+        while True:
+            if self.peek() == "AND":
+                self.pos += 1
+            elif not (self.default_op == "AND" and self.starts_operand()):
+                break
+            children.append(self.parse_not())
+        return children[0] if len(children) == 1 else And(children)
+
+    def parse_not(self):
+        token = self.peek()
+        if token is None:
+            raise ValueError("Unexpected end of query.")
+        self.pos += 1
+        if token == "NOT":
+            return Not(self.parse_not())
+        if token == "(":
+            node = self.parse_or()
+            if self.peek() != ")":
+                raise ValueError("Missing closing parenthesis in query.")
+            self.pos += 1
+            return node
+        if token in self.OPERATORS or token == ")":
+            raise ValueError(f"Unexpected '{token}' in query.")
+        return Term(token)
+
+
+class QueryPlanner:
+    """
+    Rewrites a parsed boolean query against the index and evaluates it.
+
+    Terms are resolved to posting lists, stopwords are dropped and unknown
+    terms become empty lists. Nested operators of the same kind are
+    flattened, a conjunction with an empty operand is empty without reading
+    anything, and the operands of a conjunction are evaluated from the
+    cheapest (lowest document frequency) to the most expensive. Every
+    operand after the first and every NOT is evaluated only on the
+    candidates left, skipping through its posting lists, so the work is
+    bounded by the smallest intermediate result rather than by the longest
+    posting list.
+    """
+
+    class Leaf:
+        def __init__(self, posting):
+            self.posting = posting
+            self.cost = posting.len()
+
+        def __repr__(self):
+            return f"Leaf(df={self.cost})"
+
+    # Term dropped from the query, e.g. a stopword
+    IGNORED = None
+
+    def __init__(self, resolve, all_docids, cover=None):
+        # resolve(text) returns the posting lists of the tokens of a term,
+        # an empty list if none is left after preprocessing, None if one of
+        # them is not in the lexicon
+        self.resolve = resolve
+        self.all_docids = all_docids
+        # cover(postings) may replace some of the posting lists of a
+        # conjunction by lists of the docids they share, e.g. from a cache
+        self.cover = cover
+        self.postings = []  # Posting lists read by the evaluation
+
+    def plan(self, node):
+        if isinstance(node, Term):
+            return self.plan_term(node)
+        if isinstance(node, Not):
+            child = self.plan(node.child)
+            if child is self.IGNORED:
+                return self.IGNORED
+            if isinstance(child, Not):
+                return child.child
+            planned = Not(child)
+            planned.cost = math.inf  # Complement, only evaluated if needed
+            return planned
+        if isinstance(node, And):
+            return self.plan_and([self.plan(child) for child in node.children])
+        return self.plan_or([self.plan(child) for child in node.children])
+
+    def plan_term(self, node):
+        postings = self.resolve(node.text)
+        if postings is None:
+            return self.empty()
+        if not postings:
+            return self.IGNORED
+        if len(postings) == 1:
+            return QueryPlanner.Leaf(postings[0])
+        # A term split by the preprocessor in several tokens needs them all
+        return self.plan_and([QueryPlanner.Leaf(p) for p in postings])
+
+    def empty(self):
+        node = Or([])
+        node.cost = 0
+        return node
+
+    def is_empty(self, node):
+        return isinstance(node, Or) and not node.children
+
+    def plan_and(self, planned):
+        children = []
+        for child in planned:
+            if child is self.IGNORED:
+                continue
+            if self.is_empty(child):
+                return self.empty()  # Short-circuit the whole conjunction
+            if isinstance(child, And):
+                children.extend(child.children)
+            else:
+                children.append(child)
+        if not children:
+            return self.IGNORED
+        if len(children) == 1:
+            return children[0]
+        # Rarest operands first, NOTs last as they only filter candidates
+        children.sort(key=lambda child: child.cost)
+        result = And(children)
+        result.cost = children[0].cost
+        return result
+
+    def plan_or(self, planned):
+        children = []
+        ignored = False
+        for child in planned:
+            if child is self.IGNORED:
+                ignored = True
+            elif isinstance(child, Or):
+                children.extend(child.children)
+            else:
+                children.append(child)
+        if not children:
+            return self.IGNORED if ignored else self.empty()
+        if len(children) == 1:
+            return children[0]
+        result = Or(children)
+        result.cost = sum(child.cost for child in children)
+        return result
+
+    def evaluate(self, node, within=None):
+        """
+        Return the sorted docids matching a planned node. When within is
+        given, only the docids of within are considered.
+        """
+        if node is self.IGNORED:
+            return []
+        if isinstance(node, QueryPlanner.Leaf):
+            return self.evaluate_leaf(node, within)
+        if isinstance(node, Not):
+            if within is None:
+                within = self.all_docids()
+            return self.exclude(within, self.evaluate(node.child, within))
+        if isinstance(node, And):
+            return self.evaluate_and(node, within)
+        return self.evaluate_or(node, within)
+
+    def evaluate_leaf(self, node, within):
+        posting = node.posting
+        self.postings.append(posting)
+        if within is None:
+            posting.pos = posting.len()  # Read as a whole
+            return list(posting.docids)
+        # Skip through the posting list to each candidate
+        result = []
+        for docid in within:
+            posting.next(docid)
+            if posting.is_end_list():
+                break
+            if posting.docid() == docid:
+                result.append(docid)
+        return result
+
+    def evaluate_and(self, node, within):
+        children = node.children
+        if self.cover is not None:
+            children = self.cover_leaves(children)
+        candidates = within
+        for child in children:
+            if isinstance(child, Not):
+                if candidates is None:
+                    candidates = self.all_docids()
+                excluded = self.evaluate(child.child, candidates)
+                candidates = self.exclude(candidates, excluded)
+            else:
+                candidates = self.evaluate(child, candidates)
+            if not candidates:
+                return []
+        return candidates
+
+    def cover_leaves(self, children):
+        leaves = [c for c in children if isinstance(c, QueryPlanner.Leaf)]
+        if len(leaves) < 2:
+            return children
+        postings = self.cover([leaf.posting for leaf in leaves])
+        if len(postings) == len(leaves):
+            return children
+        others = [c for c in children if not isinstance(c, QueryPlanner.Leaf)]
+        children = [QueryPlanner.Leaf(posting) for posting in postings]
+        return sorted(children + others, key=lambda child: child.cost)
+
+    def evaluate_or(self, node, within):
+        if within is None:
+            matched = set()
+            for child in node.children:
+                matched.update(self.evaluate(child))
+            return sorted(matched)
+        # Each operand only looks at the candidates no operand matched yet
+        result = []
+        remaining = within
+        for child in node.children:
+            if not remaining:
+                break
+            hits = self.evaluate(child, remaining)
+            result.extend(hits)
+            remaining = self.exclude(remaining, hits)
+        return sorted(result)
+
+    @staticmethod
+    def exclude(docids, excluded):
+        if not excluded:
+            return docids
+        excluded = set(excluded)
+        return [docid for docid in docids if docid not in excluded]
@@ -0,0 +1,131 @@
+from bisect import bisect_left
+from itertools import combinations
+
+from .metrics import metrics
+
+
+class IntersectionCache:
+    """
+    Cache of the docids shared by the posting lists of two terms, for the
+    term pairs seen most often in conjunctive queries. Every conjunction
+    counts all its term pairs; a pair is only cached once it has been seen
+    min_frequency times, and at most max_size docids are kept overall. To
+    make room, the cached pairs seen least often are evicted, but never for
+    a pair seen less often than them. Counts are halved when more than
+    max_tracked pairs are counted, so that old queries weigh less.
+    """
+
+    def __init__(self, max_size=10**6, min_frequency=2, max_tracked=10**5):
+        self.max_size = max_size
+        self.min_frequency = min_frequency
+        self.max_tracked = max_tracked
+        self.frequency = {}  # (termid, termid) -> times seen in a query
+        self.entries = {}  # (termid, termid) -> sorted docids of both terms
+        self.size = 0  # Docids held by the entries
+
+    def __len__(self):
+        return len(self.entries)
+
+    def __contains__(self, pair):
+        return pair in self.entries
+
+    @staticmethod
+    def key(termid1, termid2):
+        return (termid1, termid2) if termid1 < termid2 else (termid2, termid1)
+
+    @staticmethod
+    def intersect(docids1, docids2):
+        # Look up every docid of the shorter list in the longer one, each
+        # search starting where the previous one stopped
+        if len(docids1) > len(docids2):
+            docids1, docids2 = docids2, docids1
+        result = []
+        pos, end = 0, len(docids2)
+        for docid in docids1:
+            pos = bisect_left(docids2, docid, pos)
+            if pos == end:
+                break
+            if docids2[pos] == docid:
+                result.append(docid)
+        return result
+
+    def frequency_of(self, pair):
+        return self.frequency.get(pair, 0)
+
+    def observe(self, pairs):
+        for pair in pairs:
+            self.frequency[pair] = self.frequency.get(pair, 0) + 1
+        if len(self.frequency) > self.max_tracked:
+            counts = self.frequency.items()
+            self.frequency = {p: c // 2 for p, c in counts if c > 1}
+
+    def put(self, pair, docids):
+        # Return whether the pair has been cached
+        if len(docids) > self.max_size:
+            return False
+        frequency = self.frequency_of(pair)
+        victims = []
+        freed = 0
+        if self.size + len(docids) > self.max_size:
+            for victim in sorted(self.entries, key=self.frequency_of):
+                if self.frequency_of(victim) >= frequency:
+                    return False  # Every candidate victim is hotter
+                victims.append(victim)
+                freed += len(self.entries[victim])
+                if self.size + len(docids) - freed <= self.max_size:
+                    break
+        for victim in victims:
+            self.size -= len(self.entries.pop(victim))
+        self.entries[pair] = docids
+        self.size += len(docids)
+        return True
+
+    def cover(self, postings):
+        """
+        Replace pairs of posting lists of a conjunction by their cached
+        intersection. Return the posting lists left and the docid lists of
+        the intersections used, which the conjunction must also contain.
+        A frequent pair which is not cached yet is intersected and cached.
+        """
+        by_termid = {}
+        for posting in postings:
+            if posting.termid is not None:
+                by_termid.setdefault(posting.termid, posting)
+        if len(by_termid) < 2:
+            return postings, []
+
+        pairs = [self.key(*pair) for pair in combinations(by_termid, 2)]
+        self.observe(pairs)
+
+        covered = set()
+        intersections = []
+        # Smallest cached intersections first, pairs must not overlap
+        for pair in sorted(
+            (pair for pair in pairs if pair in self.entries),
+            key=lambda pair: len(self.entries[pair]),
+        ):
+            if pair[0] in covered or pair[1] in covered:
+                continue
+            covered.update(pair)
+            intersections.append(self.entries[pair])
+
+        if intersections:
+            metrics.incr("pair_cache_hits", len(intersections))
+        else:
+            metrics.incr("pair_cache_misses")
+            # The two shortest lists are the ones intersected first anyway
+            shortest = sorted(by_termid.values(), key=lambda p: p.len())
+            pair = self.key(shortest[0].termid, shortest[1].termid)
+            if self.frequency_of(pair) >= self.min_frequency:
+                first, second = shortest[:2]
+                docids = self.intersect(first.docids, second.docids)
+                self.put(pair, docids)
+                covered.update(pair)
+                intersections.append(docids)
+
+        rest = [
+            posting
+            for posting in postings
+            if posting.termid is None or posting.termid not in covered
+        ]
+        return rest, intersections
@@ -0,0 +1,217 @@
+import mmap
+import struct
+from array import array
+
+
+class DocumentTable:
+    """
+    Read-only document index stored column by column for a contiguous
+    range of docids, usable directly from a memory-mapped file.
+
+    doclens is a dense integer array indexed by docid - first_docid, urls
+    and titles are UTF-8 blobs where the text of the i-th document spans
+    offsets[i]:offsets[i + 1]. Document lengths are read without building
+    any per-document object and a url or title is decoded only for the
+    documents shown in the results.
+    """
+
+    MAGIC = b"BHDT"
+    VERSION = 1
+    # magic, version, first_docid, num_docs, urls_len, titles_len: 40 bytes,
+    # so that the sections after it start 8 bytes aligned
+    HEADER = struct.Struct("<4sIQQQQ")
+
+    def __init__(
+        self,
+        first_docid,
+        doclens,
+        url_offsets,
+        urls,
+        title_offsets,
+        titles,
+    ):
+        self.first_docid = first_docid
+        self.doclens = doclens
+        self.url_offsets = url_offsets
+        self.urls = urls
+        self.title_offsets = title_offsets
+        self.titles = titles
+        self.mmap = None  # Kept open while the table is in use
+        # (buffer, start) the texts are decoded from: slicing the mmap
+        # itself is cheaper than slicing a memoryview of it
+        self.url_source = (urls, 0)
+        self.title_source = (titles, 0)
+
+    @staticmethod
+    def _encode_texts(texts):
+        offsets = array("Q", [0])
+        blob = bytearray()
+        for text in texts:
+            blob += text.encode("utf-8")
+            offsets.append(len(blob))
+        return offsets, bytes(blob)
+
+    @classmethod
+    def build(cls, doclens, urls, titles, first_docid=0):
+        """Build a table from parallel lists, the i-th document being
+        first_docid + i."""
+        url_offsets, url_blob = cls._encode_texts(urls)
+        title_offsets, title_blob = cls._encode_texts(titles)
+        return cls(
+            first_docid,
+            array("I", doclens),
+            url_offsets,
+            url_blob,
+            title_offsets,
+            title_blob,
+        )
+
+    @classmethod
+    def from_dict(cls, doc_index: dict):
+        # Document index of the indexes saved before, {docid: {"doclen",
+        # "url", "title"}} with contiguous docids
+        docids = sorted(doc_index)
+        docs = [doc_index[docid] for docid in docids]
+        return cls.build(
+            [doc["doclen"] for doc in docs],
+            [doc["url"] for doc in docs],
+            [doc["title"] for doc in docs],
+            docids[0] if docids else 0,
+        )
+
+    def save(self, output_file: str):
+        sections = [
+            array("I", self.doclens).tobytes(),
+            array("Q", self.url_offsets).tobytes(),
+            array("Q", self.title_offsets).tobytes(),
+            bytes(self.urls),
+            bytes(self.titles),
+        ]
+        with open(output_file, "wb") as f:
+            f.write(
+                self.HEADER.pack(
+                    self.MAGIC,
+                    self.VERSION,
+                    self.first_docid,
+                    len(self),
+                    len(self.urls),
+                    len(self.titles),
+                )
+            )
+            for section in sections:
+                f.write(section)
+                # Keep every section 8 bytes aligned
+                f.write(b"\0" * (-len(section) % 8))
+
+    @classmethod
+    def load(cls, input_file: str):
+        """Memory-map a table written by save without copying it."""
+        with open(input_file, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        header = cls.HEADER.unpack_from(mm)
+        magic, version, first_docid, num_docs, urls_len, titles_len = header
+        if magic != cls.MAGIC:
+            raise ValueError(f"File {input_file} is not a document table.")
+        if version != cls.VERSION:
+            # The first tables had a 36 bytes header and no version
+            raise ValueError(
+                f"File {input_file} is a document table of another version. \
+                    Rebuild the index."
+            )
+
+        view = memoryview(mm)
+        offset = cls.HEADER.size
+
+        def section(size):
+            nonlocal offset
+            data = view[offset : offset + size]  # noqa
+            offset += size + (-size % 8)
+            return data
+
+        doclens = section(4 * num_docs).cast("I")
+        url_offsets = section(8 * (num_docs + 1)).cast("Q")
+        title_offsets = section(8 * (num_docs + 1)).cast("Q")
+        urls_start = offset
+        urls = section(urls_len)
+        titles_start = offset
+        titles = section(titles_len)
+
+        table = cls(
+            first_docid,
+            doclens,
+            url_offsets,
+            urls,
+            title_offsets,
+            titles,
+        )
+        table.mmap = mm
+        table.url_source = (mm, urls_start)
+        table.title_source = (mm, titles_start)
+        return table
+
+    def __len__(self):
+        return len(self.doclens)
+
+    def docids(self):
+        return range(self.first_docid, self.first_docid + len(self))
+
+    def __iter__(self):
+        return iter(self.docids())
+
+    def __contains__(self, docid):
+        return 0 <= docid - self.first_docid < len(self)
+
+    def doclen(self, docid):
+        return self.doclens[docid - self.first_docid]
+
+    def scores(self, docids, freqs):
+        # freq / doclen of every posting of a posting list
+        doclens = self.doclens
+        first = self.first_docid
+        postings = zip(docids, freqs)
+        return [freq / doclens[docid - first] for docid, freq in postings]
+
+    @staticmethod
+    def _text(offsets, source, i):
+        blob, start = source
+        begin, end = start + offsets[i], start + offsets[i + 1]
+        return blob[begin:end].decode()
+
+    def url(self, docid):
+        i = docid - self.first_docid
+        return self._text(self.url_offsets, self.url_source, i)
+
+    def title(self, docid):
+        i = docid - self.first_docid
+        return self._text(self.title_offsets, self.title_source, i)
+
+    def slice(self, first, last):
+        """Table of the docids first..last - 1."""
+        docids = range(first, last)
+        return DocumentTable.build(
+            [self.doclen(docid) for docid in docids],
+            [self.url(docid) for docid in docids],
+            [self.title(docid) for docid in docids],
+            first,
+        )
+
+    def reorder(self, order):
+        """Table where docid first_docid + i is the document order[i]."""
+        return DocumentTable.build(
+            [self.doclen(docid) for docid in order],
+            [self.url(docid) for docid in order],
+            [self.title(docid) for docid in order],
+            self.first_docid,
+        )
+
+    def to_dict(self):
+        # {docid: {"doclen", "url", "title"}}, as written to doc_index.jsonl
+        return {
+            docid: {
+                "doclen": self.doclen(docid),
+                "url": self.url(docid),
+                "title": self.title(docid),
+            }
+            for docid in self
+        }
@@ -1,10 +1,14 @@
 import json
+from bisect import bisect_left
 from collections import Counter, defaultdict
 from pathlib import Path
 from typing import Literal
 
 from tqdm.auto import tqdm
 
+from .documents import DocumentTable
+from .models import ImpactIndex, TierIndex
+from .reordering import GraphBisection
 from .utils import InvertedIndexManager, Preprocessor
 
 
@@ -15,6 +19,10 @@ class Indexing:
         input_folder: str,
         output_folder: str,
         lang: Literal["en", "it", "all"],  # noqa
+        impact_ordered: bool = False,
+        tier_size: int = None,
+        num_shards: int = 1,
+        reorder: Literal["bisection"] = None,  # noqa
     ) -> None:
 
         input_folder_path = Path(input_folder)
@@ -51,13 +59,29 @@ class Indexing:
         self.input_folder = input_folder
         self.output_folder = output_folder
         self.input_files = jsonl_files
+        # Also build the impact-ordered index used by score-at-a-time queries
+        self.impact_ordered = impact_ordered
+        # Also build a first tier with the tier_size best postings per term
+        self.tier_size = tier_size
+        # Split the index in num_shards document-partitioned shards
+        self.num_shards = num_shards
+        if reorder not in (None, "bisection"):
+            raise ValueError(
+                f"Docid order '{reorder}' is not supported. \
+                    It should be either None or 'bisection'."
+            )
+        # Reassign the docids once the collection is indexed
+        self.reorder = reorder
 
         # Initialize data structures
         # "term": [docid, doc_freq, col_freq] where doc_freq is the number of
         # documents in which the term appears and col_freq is the total number
         # of times the term appears in the collection
         self.lexicon = {}
-        self.doc_index = {}  # Document index
+        # Document index, one list per column while reading the input and
+        # a DocumentTable once every document is indexed
+        self.doclens, self.urls, self.titles = [], [], []
+        self.doc_index = None
         self.inv_d = defaultdict(list)  # TermID to list of DocIDs
         # TermID to list of term frequencies in each DocID
         self.inv_f = defaultdict(list)
@@ -85,7 +109,7 @@ class Indexing:
                 for line in file_content:
                     doc = json.loads(line)  # Parse JSON line
                     # Assign a new docid incrementally
-                    docid = len(self.doc_index)
+                    docid = self.num_docs
                     # Tokenize and preprocess text
                     tokens = Preprocessor.preprocess(doc["text"], self.lang)
                     # Count term frequencies in the document
@@ -126,30 +150,162 @@ class Indexing:
 
                     # Update document index
                     doclen = len(tokens)  # Document length
-                    self.doc_index[docid] = {
-                        "doclen": doclen,
-                        "url": doc["url"],
-                        "title": doc["title"],
-                    }
+                    self.doclens.append(doclen)
+                    self.urls.append(doc["url"])
+                    self.titles.append(doc["title"])
                     self.total_dl += doclen
                     self.num_docs += 1
 
+        columns = self.doclens, self.urls, self.titles
+        self.doc_index = DocumentTable.build(*columns)
+        self.doclens, self.urls, self.titles = [], [], []
+
+        if self.reorder == "bisection":
+            order = GraphBisection().order(self.inv_d, self.doc_index)
+            self.reorder_docids(order)
+
         # Properties file with collection statistics
         stats = {
             "num_docs": len(self.doc_index),
             "num_terms": len(self.lexicon),
             "total_tokens": self.total_dl,
+            "docid_order": self.reorder or "input",
+            # Size of the docids as variable-byte encoded d-gaps
+            "dgap_bytes": self.dgap_bytes(self.inv_d),
         }
 
+        if self.num_shards > 1:
+            self.save_shards(output_folder_path, stats)
+        else:
+            self.save(
+                output_folder_path,
+                self.lexicon,
+                self.inv_d,
+                self.inv_f,
+                self.doc_index,
+                stats,
+            )
+
+    def reorder_docids(self, order: list):
+        """
+        Reassign docid order[i] to i. With an order keeping similar documents
+        together, the gaps between the docids of a posting list are smaller
+        (better compression, longer skips) and related documents are
+        traversed together.
+        """
+        new_docids = {docid: i for i, docid in enumerate(order)}
+        self.doc_index = self.doc_index.reorder(order)
+        for termid, docids in self.inv_d.items():
+            new = (new_docids[docid] for docid in docids)
+            postings = sorted(zip(new, self.inv_f[termid]))
+            self.inv_d[termid] = [docid for docid, _ in postings]
+            self.inv_f[termid] = [freq for _, freq in postings]
+
+    @staticmethod
+    def dgap_bytes(inv_d: dict):
+        # Bytes needed by the posting lists stored as variable-byte d-gaps,
+        # the first docid of a list is a gap from 0
+        total = 0
+        for docids in inv_d.values():
+            previous = 0
+            for docid in docids:
+                gap = docid - previous
+                total += max(1, (gap.bit_length() + 6) // 7)
+                previous = docid
+        return total
+
+    def save(
+        self,
+        output_folder_path: Path,
+        lexicon: dict,
+        inv_d: dict,
+        inv_f: dict,
+        doc_index: DocumentTable,
+        stats: dict,
+        max_score: float = None,
+    ):
         InvertedIndexManager.save_index(
             output_folder_path=output_folder_path,
-            lexicon=self.lexicon,
-            inv_d=self.inv_d,
-            inv_f=self.inv_f,
-            doc_index=self.doc_index,
+            lexicon=lexicon,
+            inv_d=inv_d,
+            inv_f=inv_f,
+            doc_index=doc_index,
             stats=stats,
         )
 
+        if self.impact_ordered:
+            impact_index = ImpactIndex.build(
+                {"docids": inv_d, "freqs": inv_f},
+                doc_index,
+                max_score=max_score,
+            )
+            InvertedIndexManager.save_impact_index(
+                output_folder_path,
+                impact_index,
+            )
+
+        if self.tier_size:
+            tier_index = TierIndex.build(
+                {"docids": inv_d, "freqs": inv_f},
+                doc_index,
+                self.tier_size,
+            )
+            InvertedIndexManager.save_tier_index(
+                output_folder_path,
+                tier_index,
+            )
+
+    def save_shards(self, output_folder_path: Path, stats: dict):
+        # Document-partitioned shards: shard i holds a contiguous range of
+        # docids, so docids and termids stay global and the results of the
+        # shards can be merged as they are
+        max_score = None
+        if self.impact_ordered:
+            max_score = ImpactIndex.max_score_of(
+                {"docids": self.inv_d, "freqs": self.inv_f}, self.doc_index
+            )
+
+        n = self.num_shards
+        bounds = [self.num_docs * i // n for i in range(n + 1)]
+        for shard in range(n):
+            first, last = bounds[shard], bounds[shard + 1]
+            inv_d, inv_f = {}, {}
+            for termid, _, _ in self.lexicon.values():
+                postings = self.inv_d[termid]
+                start = bisect_left(postings, first)
+                end = bisect_left(postings, last, lo=start)
+                # Every shard keeps the whole lexicon, with empty posting
+                # lists for the terms it does not contain, so that a term is
+                # never dropped from a query by one shard only
+                inv_d[termid] = postings[start:end]
+                inv_f[termid] = self.inv_f[termid][start:end]
+
+            doc_index = self.doc_index.slice(first, last)
+            shard_stats = {
+                "num_docs": len(doc_index),
+                "num_terms": len(self.lexicon),
+                "total_tokens": sum(doc_index.doclens),
+                "shard": shard,
+                "num_shards": self.num_shards,
+                # Statistics of the whole collection, shared by all shards
+                "global": stats,
+            }
+
+            shard_folder_path = output_folder_path / f"shard_{shard}"
+            shard_folder_path.mkdir(exist_ok=True)
+            # The lexicon keeps the global document and collection
+            # frequencies, so that every shard ranks the expansions of a
+            # wildcard alike and expands it to the same terms
+            self.save(
+                shard_folder_path,
+                self.lexicon,
+                inv_d,
+                inv_f,
+                doc_index,
+                shard_stats,
+                max_score,
+            )
+
 
 # Entry point for command-line execution
 if __name__ == "__main__":
@@ -165,11 +321,43 @@ if __name__ == "__main__":
     parser.add_argument(
         "--lang", type=str, default="en", help="Language to use (default: 'en')"  # noqa
     )
+    parser.add_argument(
+        "--impact",
+        action="store_true",
+        help="Also build the impact-ordered index for score-at-a-time",
+    )
+    parser.add_argument(
+        "--tier-size",
+        type=int,
+        default=None,
+        help="Also build a first tier with this many postings per term",
+    )
+
+    parser.add_argument(
+        "--shards",
+        type=int,
+        default=1,
+        help="Number of document-partitioned shards (default: 1)",
+    )
+
+    parser.add_argument(
+        "--reorder",
+        choices=["bisection"],
+        default=None,
+        help="Reassign the docids by recursive graph bisection, which "
+        "shrinks the d-gaps of the posting lists (default: input order)",
+    )
 
     args = parser.parse_args()
 
     # Instantiate and run the Indexing class
     indexer = Indexing(
-        str(args.input_folder), str(args.output_folder), args.lang
-    )  # noqa
+        str(args.input_folder),
+        str(args.output_folder),
+        args.lang,
+        impact_ordered=args.impact,
+        tier_size=args.tier_size,
+        num_shards=args.shards,
+        reorder=args.reorder,
+    )
     indexer.build_index()
@@ -0,0 +1,408 @@
+import heapq
+import itertools
+import mmap
+import struct
+from array import array
+from bisect import bisect_left, bisect_right
+from fnmatch import fnmatchcase
+
+
+class TermDictionary:
+    """
+    Sorted view over the lexicon terms supporting prefix and wildcard
+    expansion. Terms are the stemmed forms stored in the lexicon, so
+    patterns are matched against stems. As a stem is often shorter than
+    the words it comes from (engineering -> engin), a prefix pattern also
+    matches the stem of its prefix given by the stemmer of the query
+    language: "engineer*" matches "engin".
+    """
+
+    def __init__(self, terms, dfs):
+        # terms must be sorted; dfs[i] is the document frequency of terms[i]
+        self.terms = terms
+        self.dfs = dfs
+        # Reversed terms, sorted, to answer patterns with a leading '*'
+        # i.e. "*ing" becomes the prefix "gni" over the reversed terms.
+        # reversed_positions[i] is the position of reversed_terms[i] in terms
+        self.reversed_terms = None
+        self.reversed_positions = None
+
+    @classmethod
+    def from_lexicon(cls, lexicon):
+        if isinstance(lexicon, FrontCodedLexicon):
+            # Already sorted, no copy of the terms is needed
+            return cls(lexicon.terms, lexicon.dfs)
+        terms = sorted(lexicon)
+        return cls(terms, [lexicon[term][1] for term in terms])
+
+    def __len__(self):
+        return len(self.terms)
+
+    @staticmethod
+    def prefix_range(terms, prefix):
+        # Binary search for the first term >= prefix, then the first term
+        # past every string starting with prefix: O(log V)
+        if isinstance(terms, FrontCodedLexicon.SortedTerms):
+            # Search the block heads, then a single block
+            lexicon = terms.lexicon
+            start = lexicon.lower_bound(prefix)
+            return start, lexicon.lower_bound(prefix + "\U0010ffff")
+        start = bisect_left(terms, prefix)
+        end = bisect_left(terms, prefix + "\U0010ffff", lo=start)
+        return start, end
+
+    def _find(self, term):
+        # Position of term in terms, or -1
+        if isinstance(self.terms, FrontCodedLexicon.SortedTerms):
+            return self.terms.lexicon.position(term)
+        i = bisect_left(self.terms, term)
+        return i if i < len(self.terms) and self.terms[i] == term else -1
+
+    def _stem_match(self, prefix, stem):
+        # Yield (term, df) for the stem of prefix when it is a term outside
+        # of the prefix range, e.g. a stem shorter than the prefix
+        term = stem(prefix)
+        if term and not term.startswith(prefix):
+            i = self._find(term)
+            if i >= 0:
+                yield term, self.dfs[i]
+
+    def _build_reversed(self):
+        # Built on the first suffix query only
+        pairs = sorted((term[::-1], i) for i, term in enumerate(self.terms))
+        self.reversed_terms = [term for term, _ in pairs]
+        self.reversed_positions = [i for _, i in pairs]
+
+    def _candidates(self, pattern):
+        # Yield (term, df) pairs which may match the pattern, narrowing the
+        # scan with the longest literal prefix or suffix of the pattern
+        first = min(
+            (i for i in (pattern.find("*"), pattern.find("?")) if i >= 0),
+            default=len(pattern),
+        )
+        prefix = pattern[:first]
+        if prefix or not pattern.startswith("*"):
+            start, end = self.prefix_range(self.terms, prefix)
+            # A slice decodes a front-coded range block by block
+            terms = self.terms[start:end]
+            yield from zip(terms, self.dfs[start:end])
+            return
+
+        last = max(pattern.rfind("*"), pattern.rfind("?"))
+        suffix = pattern[last + 1 :]  # noqa
+        if self.reversed_terms is None:
+            self._build_reversed()
+        start, end = self.prefix_range(self.reversed_terms, suffix[::-1])
+        for i in range(start, end):
+            position = self.reversed_positions[i]
+            yield self.terms[position], self.dfs[position]
+
+    def expand(self, pattern: str, max_expansions: int = 50, stem=None):
+        """
+        Return the terms matching a pattern where '*' matches any sequence
+        of characters and '?' a single one. At most max_expansions terms are
+        returned, keeping those with the highest document frequency. For a
+        prefix pattern, stem(prefix) is matched as well when given.
+        """
+        if "*" not in pattern and "?" not in pattern:
+            return [pattern] if self._find(pattern) >= 0 else []
+
+        # A single trailing '*' matches the whole prefix range
+        wildcards = pattern.count("*") + pattern.count("?")
+        is_prefix = wildcards == 1 and pattern.endswith("*")
+        matches = (
+            (term, df)
+            for term, df in self._candidates(pattern)
+            if is_prefix or fnmatchcase(term, pattern)
+        )
+        if is_prefix and stem is not None:
+            stemmed = self._stem_match(pattern[:-1], stem)
+            matches = itertools.chain(matches, stemmed)
+        best = heapq.nlargest(max_expansions, matches, key=lambda m: m[1])
+        return [term for term, _ in best]
+
+    def complete(self, prefix: str, k: int = 10):
+        """Autocomplete a prefix with the k most frequent matching terms."""
+        return self.expand(prefix + "*", max_expansions=k)
+
+
+class FrontCodedLexicon:
+    """
+    Read-only lexicon stored as front-coded sorted terms and parallel
+    integer arrays, usable directly from a memory-mapped file.
+
+    Terms are sorted and grouped in blocks of block_size terms: the first
+    term of a block is stored in full, the others as the length of the
+    prefix shared with the previous term followed by the remaining suffix.
+    A lookup binary searches the block heads and then scans one block.
+    termids, dfs and cfs are indexed by the position of the term in the
+    sorted order, so lexicon[term] gives the same [termid, df, cf] triple
+    as the dictionary lexicon built by the indexer.
+    """
+
+    MAGIC = b"BHLX"
+    # magic, block_size, num_terms, num_blocks, blob_len
+    HEADER = struct.Struct("<4sIQQQ")
+    # Number of looked up terms whose position is remembered
+    RECENT_SIZE = 4096
+
+    class SortedTerms:
+        # Sequence view of the sorted terms, usable with bisect
+        def __init__(self, lexicon):
+            self.lexicon = lexicon
+
+        def __len__(self):
+            return len(self.lexicon)
+
+        def __getitem__(self, position):
+            if isinstance(position, slice):
+                start, end, _ = position.indices(len(self))
+                return list(self.lexicon.iter_range(start, end))
+            return self.lexicon.term(position)
+
+        def __iter__(self):
+            return iter(self.lexicon)
+
+    def __init__(self, block_size, block_offsets, blob, termids, dfs, cfs):
+        self.block_size = block_size
+        self.block_offsets = block_offsets
+        self.blob = blob
+        self.termids = termids
+        self.dfs = dfs
+        self.cfs = cfs
+        self.terms = FrontCodedLexicon.SortedTerms(self)
+        self.mmap = None  # Kept open while the lexicon is in use
+        # Positions of the terms looked up last, oldest first: query terms
+        # repeat a lot and a hit skips the block scan
+        self.recent = {}
+        # First term of every block, decoded once so that the binary search
+        # over the blocks does not touch the blob
+        self.block_heads = [
+            self._block_head(block) for block in range(len(block_offsets) - 1)
+        ]
+
+    @staticmethod
+    def _encode_varint(value, out):
+        while value >= 0x80:
+            out.append((value & 0x7F) | 0x80)
+            value >>= 7
+        out.append(value)
+
+    @staticmethod
+    def _decode_varint(blob, pos):
+        value = blob[pos]
+        pos += 1
+        if value < 0x80:
+            return value, pos
+        value &= 0x7F
+        shift = 7
+        while True:
+            byte = blob[pos]
+            pos += 1
+            value |= (byte & 0x7F) << shift
+            if byte < 0x80:
+                return value, pos
+            shift += 7
+
+    @classmethod
+    def build(cls, lexicon: dict, block_size: int = 16):
+        """Build a front-coded lexicon from a {term: [termid, df, cf]} dict."""
+        terms = sorted(lexicon)
+        blob = bytearray()
+        block_offsets = array("Q")
+        previous = b""
+        for position, term in enumerate(terms):
+            encoded = term.encode("utf-8")
+            if position % block_size == 0:
+                block_offsets.append(len(blob))
+                cls._encode_varint(len(encoded), blob)
+                blob += encoded
+            else:
+                shared = 0
+                limit = min(len(previous), len(encoded))
+                while shared < limit and previous[shared] == encoded[shared]:
+                    shared += 1
+                cls._encode_varint(shared, blob)
+                cls._encode_varint(len(encoded) - shared, blob)
+                blob += encoded[shared:]
+            previous = encoded
+        block_offsets.append(len(blob))
+
+        return cls(
+            block_size,
+            block_offsets,
+            bytes(blob),
+            array("I", (lexicon[term][0] for term in terms)),
+            array("I", (lexicon[term][1] for term in terms)),
+            array("Q", (lexicon[term][2] for term in terms)),
+        )
+
+    def save(self, output_file: str):
+        sections = [
+            self.block_offsets.tobytes(),
+            array("I", self.termids).tobytes(),
+            array("I", self.dfs).tobytes(),
+            array("Q", self.cfs).tobytes(),
+            bytes(self.blob),
+        ]
+        with open(output_file, "wb") as f:
+            f.write(
+                self.HEADER.pack(
+                    self.MAGIC,
+                    self.block_size,
+                    len(self.termids),
+                    len(self.block_offsets) - 1,
+                    len(self.blob),
+                )
+            )
+            for section in sections:
+                f.write(section)
+                # Keep every section 8 bytes aligned
+                f.write(b"\0" * (-len(section) % 8))
+
+    @classmethod
+    def load(cls, input_file: str):
+        """Memory-map a lexicon written by save without copying it."""
+        with open(input_file, "rb") as f:
+            mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        header = cls.HEADER.unpack_from(mm)
+        magic, block_size, num_terms, num_blocks, blob_len = header
+        if magic != cls.MAGIC:
+            raise ValueError(f"File {input_file} is not a lexicon file.")
+
+        view = memoryview(mm)
+        offset = cls.HEADER.size
+
+        def section(size):
+            nonlocal offset
+            data = view[offset : offset + size]  # noqa
+            offset += size + (-size % 8)
+            return data
+
+        block_offsets = section(8 * (num_blocks + 1)).cast("Q")
+        termids = section(4 * num_terms).cast("I")
+        dfs = section(4 * num_terms).cast("I")
+        cfs = section(8 * num_terms).cast("Q")
+        blob = section(blob_len)
+
+        lexicon = cls(block_size, block_offsets, blob, termids, dfs, cfs)
+        lexicon.mmap = mm
+        return lexicon
+
+    def __len__(self):
+        return len(self.termids)
+
+    def _block_head(self, block):
+        length, pos = self._decode_varint(self.blob, self.block_offsets[block])
+        return bytes(self.blob[pos : pos + length])  # noqa
+
+    def _scan_block(self, block):
+        # Yield the terms of a block, as bytes, in sorted order
+        blob = self.blob
+        decode = self._decode_varint
+        pos = self.block_offsets[block]
+        end = self.block_offsets[block + 1]
+        # Decode the whole block at once, slicing the memoryview is slower
+        data = bytes(blob[pos:end])
+        length, pos = decode(data, 0)
+        term = data[pos : pos + length]  # noqa
+        pos += length
+        yield term
+        end = len(data)
+        while pos < end:
+            shared = data[pos]
+            if shared < 0x80:
+                pos += 1
+            else:
+                shared, pos = decode(data, pos)
+            length = data[pos]
+            if length < 0x80:
+                pos += 1
+            else:
+                length, pos = decode(data, pos)
+            term = term[:shared] + data[pos : pos + length]  # noqa
+            pos += length
+            yield term
+
+    def term(self, position):
+        if not 0 <= position < len(self):
+            raise IndexError("lexicon position out of range")
+        block, rank = divmod(position, self.block_size)
+        for i, term in enumerate(self._scan_block(block)):
+            if i == rank:
+                return term.decode("utf-8")
+
+    def iter_range(self, start, end):
+        """Yield the terms at positions start..end - 1 in sorted order,
+        decoding every block once."""
+        if start >= end:
+            return
+        first = start // self.block_size
+        last = (end - 1) // self.block_size
+        blocks = map(self._scan_block, range(first, last + 1))
+        terms = itertools.chain.from_iterable(blocks)
+        offset = first * self.block_size
+        for term in itertools.islice(terms, start - offset, end - offset):
+            yield term.decode("utf-8")
+
+    def lower_bound(self, term):
+        """Return the position of the first term >= term."""
+        encoded = term.encode("utf-8")
+        block = bisect_right(self.block_heads, encoded) - 1
+        if block < 0:
+            return 0
+        for rank, candidate in enumerate(self._scan_block(block)):
+            if candidate >= encoded:
+                return block * self.block_size + rank
+        # The head of the next block is > term
+        return min((block + 1) * self.block_size, len(self))
+
+    def position(self, term):
+        """Return the position of a term in the sorted order, or -1."""
+        position = self.recent.get(term)
+        if position is None:
+            position = self._search(term)
+            if len(self.recent) >= self.RECENT_SIZE:
+                del self.recent[next(iter(self.recent))]
+            self.recent[term] = position
+        return position
+
+    def _search(self, term):
+        encoded = term.encode("utf-8")
+        # Binary search for the last block whose head is <= term
+        block = bisect_right(self.block_heads, encoded) - 1
+        if block < 0:
+            return -1
+        if self.block_heads[block] == encoded:
+            return block * self.block_size
+        for rank, candidate in enumerate(self._scan_block(block)):
+            if candidate == encoded:
+                return block * self.block_size + rank
+            if candidate > encoded:
+                break
+        return -1
+
+    def __contains__(self, term):
+        return self.position(term) >= 0
+
+    def __getitem__(self, term):
+        entry = self.get(term)
+        if entry is None:
+            raise KeyError(term)
+        return entry
+
+    def get(self, term, default=None):
+        position = self.position(term)
+        if position < 0:
+            return default
+        return [
+            self.termids[position],
+            self.dfs[position],
+            self.cfs[position],
+        ]
+
+    def __iter__(self):
+        for block in range(len(self.block_offsets) - 1):
+            for term in self._scan_block(block):
+                yield term.decode("utf-8")
@@ -0,0 +1,227 @@
+import functools
+import json
+import time
+from bisect import bisect_left
+from collections import defaultdict, deque
+
+
+class Histogram:
+    # Upper bounds in seconds of the latency buckets
+    BUCKETS = (
+        0.0001,
+        0.00025,
+        0.0005,
+        0.001,
+        0.0025,
+        0.005,
+        0.01,
+        0.025,
+        0.05,
+        0.1,
+        0.25,
+        0.5,
+        1.0,
+    )
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # Last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        # (upper bound, number of observations <= upper bound) pairs
+        total = 0
+        for bound, count in zip(self.buckets + (float("inf"),), self.counts):
+            total += count
+            yield bound, total
+
+    def to_dict(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "buckets": {
+                ("+Inf" if bound == float("inf") else str(bound)): total
+                for bound, total in self.cumulative()
+            },
+        }
+
+
+class Metrics:
+    """
+    Per-stage query instrumentation. Stages are timed exclusively: the time
+    of a stage nested in another is not counted in the outer one, so the
+    stages of a query add up to its total time. Counters (postings scanned
+    and skipped, heap insertions, cache hits, ...) are kept per query and in
+    total. When disabled every call returns immediately.
+    """
+
+    class Stage:
+        def __init__(self, metrics, name):
+            self.metrics = metrics
+            self.name = name
+
+        def __enter__(self):
+            self.start = time.perf_counter()
+            self.children = 0.0
+            self.metrics.stack.append(self)
+            return self
+
+        def __exit__(self, *exc):
+            elapsed = time.perf_counter() - self.start
+            self.metrics.stack.pop()
+            if self.metrics.stack:
+                self.metrics.stack[-1].children += elapsed
+            self.metrics.observe_stage(self.name, elapsed - self.children)
+
+    class Query:
+        def __init__(self, metrics, mode):
+            self.metrics = metrics
+            self.mode = mode
+
+        def __enter__(self):
+            self.record = {"mode": self.mode, "stages": {}, "counters": {}}
+            self.metrics.current = self.record
+            self.start = time.perf_counter()
+            return self
+
+        def __exit__(self, *exc):
+            elapsed = time.perf_counter() - self.start
+            self.record["seconds"] = elapsed
+            self.metrics.queries[self.mode].observe(elapsed)
+            self.metrics.recent.append(self.record)
+            self.metrics.current = None
+
+    class Disabled:
+        # Shared no-op context manager returned while disabled
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc):
+            pass
+
+    DISABLED = Disabled()
+
+    def __init__(self, enabled=False, recent=100):
+        self.enabled = enabled
+        self.recent_size = recent
+        self.reset()
+
+    def reset(self):
+        self.stages = defaultdict(Histogram)  # stage -> latency histogram
+        self.queries = defaultdict(Histogram)  # mode -> latency histogram
+        self.counters = defaultdict(int)
+        self.recent = deque(maxlen=self.recent_size)  # Last query records
+        self.current = None
+        self.stack = []
+
+    def query(self, mode):
+        if not self.enabled or self.current is not None:
+            # Queries run by another query (e.g. a fallback) are part of it
+            return self.DISABLED
+        return Metrics.Query(self, mode)
+
+    def stage(self, name):
+        if not self.enabled:
+            return self.DISABLED
+        return Metrics.Stage(self, name)
+
+    def timed(self, name):
+        # Decorator timing every call of a function as a stage
+        def decorator(f):
+            @functools.wraps(f)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return f(*args, **kwargs)
+                with Metrics.Stage(self, name):
+                    return f(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def timed_query(self, mode):
+        # Decorator recording every call of a function as a query
+        def decorator(f):
+            @functools.wraps(f)
+            def wrapper(*args, **kwargs):
+                if not self.enabled:
+                    return f(*args, **kwargs)
+                with self.query(mode):
+                    return f(*args, **kwargs)
+
+            return wrapper
+
+        return decorator
+
+    def observe_stage(self, name, seconds):
+        self.stages[name].observe(seconds)
+        if self.current is not None:
+            stages = self.current["stages"]
+            stages[name] = stages.get(name, 0.0) + seconds
+
+    def incr(self, name, value=1):
+        if not self.enabled:
+            return
+        self.counters[name] += value
+        if self.current is not None:
+            counters = self.current["counters"]
+            counters[name] = counters.get(name, 0) + value
+
+    def observe_postings(self, postings):
+        # Postings moved over by a traversal, one by one or skipped
+        if not self.enabled:
+            return
+        skipped = sum(posting.skipped for posting in postings)
+        self.incr("postings_scanned", sum(p.pos for p in postings) - skipped)
+        self.incr("postings_skipped", skipped)
+
+    def to_dict(self):
+        return {
+            "queries": {m: h.to_dict() for m, h in self.queries.items()},
+            "stages": {s: h.to_dict() for s, h in self.stages.items()},
+            "counters": dict(self.counters),
+            "recent": list(self.recent),
+        }
+
+    def to_json(self):
+        return json.dumps(self.to_dict(), indent=4)
+
+    def to_prometheus(self, prefix="unipi_search"):
+        lines = []
+
+        def histogram(name, label, histograms):
+            metric = f"{prefix}_{name}"
+            lines.append(f"# TYPE {metric} histogram")
+            for value, h in sorted(histograms.items()):
+                labels = f'{label}="{value}"'
+                for bound, total in h.cumulative():
+                    le = "+Inf" if bound == float("inf") else bound
+                    bucket = f'{labels},le="{le}"'
+                    lines.append(f"{metric}_bucket{{{bucket}}} {total}")
+                lines.append(f"{metric}_sum{{{labels}}} {h.sum}")
+                lines.append(f"{metric}_count{{{labels}}} {h.count}")
+
+        histogram("query_seconds", "mode", self.queries)
+        histogram("stage_seconds", "stage", self.stages)
+        for name, value in sorted(self.counters.items()):
+            lines.append(f"# TYPE {prefix}_{name}_total counter")
+            lines.append(f"{prefix}_{name}_total {value}")
+        return "\n".join(lines) + "\n"
+
+    def export(self, output_file: str):
+        # JSON for .json files, Prometheus text exposition format otherwise
+        with open(output_file, "w", encoding="utf-8") as f:
+            if str(output_file).endswith(".json"):
+                f.write(self.to_json())
+            else:
+                f.write(self.to_prometheus())
+
+
+# Process-wide metrics, disabled until enabled by the CLI or a server
+metrics = Metrics()
@@ -1,15 +1,23 @@
 import heapq
 import math
+from bisect import bisect_left
+from collections import defaultdict
+from itertools import groupby
+
+from .lexicon import TermDictionary
+from .metrics import metrics
 
 
 class InvertedIndex:
 
     class PostingListIterator:
-        def __init__(self, docids, freqs, doc):
+        def __init__(self, docids, freqs, doc, termid=None):
             self.docids = docids
             self.freqs = freqs
             self.pos = 0
             self.doc = doc
+            self.termid = termid  # None for merged or cached lists
+            self.skipped = 0  # Postings jumped over by next(target)
 
         def docid(self):
             if self.is_end_list():
@@ -19,18 +27,20 @@ class InvertedIndex:
         def score(self):
             if self.is_end_list():
                 return math.inf
-            return self.freqs[self.pos] / self.doc[self.docid()]["doclen"]
+            doc = self.doc
+            docid = self.docids[self.pos]
+            return self.freqs[self.pos] / doc.doclens[docid - doc.first_docid]
 
         def next(self, target=None):
-            if not target:
+            if target is None:
                 if not self.is_end_list():
                     self.pos += 1
             else:
+                # Move to the first docid >= target
                 if target > self.docid():
-                    try:
-                        self.pos = self.docids.index(target, self.pos)
-                    except ValueError:
-                        self.pos = len(self.docids)
+                    start = self.pos
+                    self.pos = bisect_left(self.docids, target, self.pos)
+                    self.skipped += self.pos - start
 
         def is_end_list(self):
             return self.pos == len(self.docids)
@@ -43,29 +53,70 @@ class InvertedIndex:
         self.inv = inv
         self.doc = doc
         self.stat = stats
+        self.terms = None  # Sorted term dictionary, built on first use
 
     def num_docs(self):
-        return self.stats["num_docs"]
+        return self.stat["num_docs"]
+
+    def all_docids(self):
+        # Sorted docids of the index, not always 0..num_docs-1 in a shard
+        return list(self.doc.docids())
 
     def get_posting(self, termid):
         return InvertedIndex.PostingListIterator(
-            self.inv["docids"][termid], self.inv["freqs"][termid], self.doc
+            self.inv["docids"][termid],
+            self.inv["freqs"][termid],
+            self.doc,
+            termid,
         )
 
+    def get_docid_posting(self, docids):
+        # Posting list without frequencies, for conjunctive processing only
+        return InvertedIndex.PostingListIterator(docids, None, self.doc)
+
     def get_termids(self, tokens):
-        return [
-            self.lexicon[token][0] for token in tokens if token in self.lexicon
-        ]  # noqa
+        # One lookup per token, a front-coded lexicon searches on every call
+        entries = (self.lexicon.get(token) for token in tokens)
+        return [entry[0] for entry in entries if entry is not None]
 
+    @metrics.timed("postings")
     def get_postings(self, termids):
         return [self.get_posting(termid) for termid in termids]
 
+    def get_term_dictionary(self):
+        if self.terms is None:
+            self.terms = TermDictionary.from_lexicon(self.lexicon)
+        return self.terms
+
+    def expand_terms(self, pattern, max_expansions=50, stem=None):
+        terms = self.get_term_dictionary()
+        return terms.expand(pattern, max_expansions, stem)
+
+    def get_merged_posting(self, termids):
+        # Union of several posting lists seen as a single term: the frequency
+        # of a document is the sum of its frequencies in each list
+        merged = heapq.merge(
+            *(
+                zip(self.inv["docids"][termid], self.inv["freqs"][termid])
+                for termid in termids
+            )
+        )
+        docids, freqs = [], []
+        for docid, group in groupby(merged, key=lambda p: p[0]):
+            docids.append(docid)
+            freqs.append(sum(freq for _, freq in group))
+        return InvertedIndex.PostingListIterator(docids, freqs, self.doc)
+
 
 class TopQueue:
-    def __init__(self, k=10, threshold=0.0):
+    def __init__(self, k=10, threshold=0.0, shared=None):
         self.queue = []
         self.k = k
         self.threshold = threshold
+        # Optional multiprocessing.Value with a threshold shared by the queues
+        # of the same query in other processes, e.g. one queue per shard
+        self.shared = shared
+        self.insertions = 0
 
     def size(self):
         return len(self.queue)
@@ -82,12 +133,107 @@ class TopQueue:
         return f"<{self.size()} items, th={self.threshold} {self.queue}"
 
     def insert(self, docid, score):
+        if self.shared is not None and self.shared.value > self.threshold:
+            self.threshold = self.shared.value
         if score > self.threshold:
             if self.size() >= self.k:
                 heapq.heapreplace(self.queue, (score, docid))
             else:
                 heapq.heappush(self.queue, (score, docid))
+            self.insertions += 1
             if self.size() >= self.k:
                 self.threshold = max(self.threshold, self.queue[0][0])
+                # A full queue proves k scores above the threshold, so the
+                # other queues can discard anything below it
+                if self.shared is not None:
+                    self.shared.value = max(self.shared.value, self.threshold)
             return True
         return False
+
+
+class ImpactIndex:
+    """
+    Impact-ordered variant of the inverted index. The score of every
+    posting is precomputed and quantised to an integer impact in
+    [1, levels], and the postings of a term are grouped in segments of
+    equal impact sorted from the highest impact to the lowest. Inside a
+    segment docids are sorted.
+    """
+
+    def __init__(self, segments, max_score, levels):
+        # termid -> [(impact, [docids]), ...] by decreasing impact
+        self.segments = segments
+        self.max_score = max_score
+        self.levels = levels
+
+    @staticmethod
+    def max_score_of(inv, doc):
+        # Same score as InvertedIndex.PostingListIterator.score
+        max_score = 0.0
+        for termid, docids in inv["docids"].items():
+            scores = doc.scores(docids, inv["freqs"][termid])
+            max_score = max(max_score, max(scores, default=0.0))
+        return max_score
+
+    @classmethod
+    def build(cls, inv, doc, levels=255, max_score=None):
+        # Shards quantise with the max_score of the whole collection so that
+        # their impacts are comparable
+        if max_score is None:
+            max_score = cls.max_score_of(inv, doc)
+
+        segments = {}
+        for termid, docids in inv["docids"].items():
+            by_impact = defaultdict(list)
+            scores = doc.scores(docids, inv["freqs"][termid])
+            for docid, score in zip(docids, scores):
+                impact = max(1, math.ceil(score / max_score * levels))
+                by_impact[impact].append(docid)
+            segments[termid] = sorted(by_impact.items(), reverse=True)
+        return cls(segments, max_score, levels)
+
+    def get_segments(self, termid):
+        return self.segments.get(termid, [])
+
+    def to_score(self, impact):
+        # Approximate score corresponding to a (sum of) impact(s)
+        return impact * self.max_score / self.levels
+
+
+class TierIndex:
+    """
+    First tier of a tiered index: for every term only the tier_size
+    postings with the highest score, in docid order. bounds[termid] is the
+    highest score among the postings left out of the tier, 0 when the whole
+    posting list fits in it.
+    """
+
+    def __init__(self, inv, bounds, tier_size):
+        self.inv = inv
+        self.bounds = bounds
+        self.tier_size = tier_size
+
+    @classmethod
+    def build(cls, inv, doc, tier_size=100):
+        docids_t, freqs_t, bounds = {}, {}, {}
+        for termid, docids in inv["docids"].items():
+            freqs = inv["freqs"][termid]
+            if len(docids) <= tier_size:
+                docids_t[termid], freqs_t[termid] = docids, freqs
+                bounds[termid] = 0.0
+                continue
+            # Same score as InvertedIndex.PostingListIterator.score
+            scores = doc.scores(docids, freqs)
+            by_score = scores.__getitem__
+            ranked = sorted(range(len(docids)), key=by_score, reverse=True)
+            kept = sorted(ranked[:tier_size])
+            docids_t[termid] = [docids[i] for i in kept]
+            freqs_t[termid] = [freqs[i] for i in kept]
+            left = ranked[tier_size]  # Best posting left out of the tier
+            bounds[termid] = scores[left]
+        return cls({"docids": docids_t, "freqs": freqs_t}, bounds, tier_size)
+
+    def get_posting(self, termid, doc):
+        return InvertedIndex.PostingListIterator(
+            self.inv["docids"][termid], self.inv["freqs"][termid], doc
+        )
@@ -1,20 +1,115 @@
+import heapq
 import math
+import re
+import time
+from bisect import bisect_left
 from collections import defaultdict
+from pathlib import Path
 
+from .boolean import QueryParser, QueryPlanner
+from .cache import IntersectionCache
+from .metrics import metrics
 from .models import InvertedIndex, TopQueue
 from .utils import InvertedIndexManager, Preprocessor
 
 
 class QueryProcessor:
 
-    def __init__(self, index_file):
+    # Query words containing '*', or '?' followed by a letter, are wildcard
+    # patterns: a trailing '?' ends a question, as in "exam date?"
+    WILDCARD = re.compile(r"\S*(?:\*|\?\w)\S*")
+
+    def __init__(self, index_file, max_expansions=50, pair_cache_size=10**6):
         lex, inv, doc, stats = InvertedIndexManager.load_index(index_file)
         self.inv_index = InvertedIndex(lex, inv, doc, stats)
         self.doc = doc
+        self.index_file = index_file
+        self.impact_index = None  # Loaded on the first score-at-a-time query
+        self.tier_index = None  # Loaded on the first tiered query
+        # How many tiered queries had to fall back to the full index
+        self.tier_stats = {"queries": 0, "fallbacks": 0}
+        # Threshold shared with the other shards when run as a shard worker
+        self.shared_threshold = None
+        # Maximum number of terms a wildcard pattern can expand to, the most
+        # frequent ones are kept
+        self.max_expansions = max_expansions
+        # Intersections of frequent term pairs, up to pair_cache_size docids
+        # in total, None to disable it
+        self.pair_cache = None
+        if pair_cache_size:
+            self.pair_cache = IntersectionCache(pair_cache_size)
+
+    @metrics.timed("lexicon")
+    def get_query_termids(self, query: str, lang: str = "english"):
+        # Return one group of termids per query term. Wildcard patterns are
+        # matched against the stemmed lexicon as they are and give a group
+        # with all their expansions, the rest of the query goes through the
+        # preprocessor
+        patterns = set(map(self.clean_pattern, self.WILDCARD.findall(query)))
+        if patterns and lang == "all":
+            # The stemmer of the patterns needs the language of the query
+            lang = Preprocessor.detect_language(query)
+        text = self.WILDCARD.sub(" ", query)
+        qtokens = set()
+        if text.strip():
+            qtokens = set(Preprocessor.preprocess(text, lang))
+        groups = [[termid] for termid in self.inv_index.get_termids(qtokens)]
+
+        for pattern in patterns:
+            termids = self.expand_pattern(pattern, lang)
+            if termids:
+                groups.append(termids)
+        return groups
+
+    def expand_pattern(self, pattern: str, lang: str = "english"):
+        # Termids of the most frequent terms matching a wildcard pattern, a
+        # prefix pattern also matching the stem of its prefix in lang
+        if not pattern.strip("*?"):
+            return []
+        terms = self.inv_index.expand_terms(
+            pattern,
+            self.max_expansions,
+            lambda prefix: Preprocessor.stem(prefix, lang),
+        )
+        return self.inv_index.get_termids(terms)
+
+    @staticmethod
+    def clean_pattern(pattern: str):
+        return re.sub(r"[^\w*?]", "", pattern.lower()).rstrip("?")
+
+    @metrics.timed("postings")
+    def get_query_postings(self, query: str, lang: str = "english"):
+        # A wildcard pattern behaves as a single term whose posting list is
+        # the union of the posting lists of its expansions
+        return [
+            (
+                self.inv_index.get_posting(group[0])
+                if len(group) == 1
+                else self.inv_index.get_merged_posting(group)
+            )
+            for group in self.get_query_termids(query, lang)
+        ]
+
+    def autocomplete(self, prefix: str, k: int = 10):
+        """Return the k most frequent lexicon terms starting with prefix."""
+        terms = self.inv_index.get_term_dictionary()
+        return terms.complete(prefix.strip().lower(), k)
 
     # Conjunctive processing
+    def cover_pairs(self, postings):
+        # Replace pairs of posting lists by their cached intersection
+        if self.pair_cache is None:
+            return postings
+        rest, intersections = self.pair_cache.cover(postings)
+        get_docid_posting = self.inv_index.get_docid_posting
+        return rest + [get_docid_posting(docids) for docids in intersections]
+
+    @metrics.timed("traversal")
     def boolean_and(self, postings):
         results = []
+        if not postings:
+            return results
+        postings = self.cover_pairs(postings)
         # We sort the posting lists from the shortest to the longest
         postings = sorted(postings, key=lambda p: p.len())
         # We scan sequentially through the shortest posting list only
@@ -33,14 +128,77 @@ class QueryProcessor:
             # We move forward in the shortest posting list
             postings[0].next()
             current_docid = postings[0].docid()
+        metrics.observe_postings(postings)
         return self.prepare_final_result(docids=results)
 
+    @metrics.timed_query("and")
     def query_process_and(self, query: str, lang: str = "english"):
-        qtokens = set(Preprocessor.preprocess(query, lang))
-        qtermids = self.inv_index.get_termids(qtokens)
-        postings = self.inv_index.get_postings(qtermids)
+        postings = self.get_query_postings(query, lang)
         return self.boolean_and(postings)
 
+    # Boolean query language
+    @metrics.timed("lexicon")
+    def get_term_termids(self, text: str, lang: str):
+        # Groups of termids of a boolean query term, as get_query_termids:
+        # empty when nothing is left after preprocessing (e.g. a stopword),
+        # None when a token is not in the lexicon
+        if self.WILDCARD.fullmatch(text):
+            termids = self.expand_pattern(self.clean_pattern(text), lang)
+            return [termids] if termids else None
+
+        tokens = set(Preprocessor.preprocess(text, lang))
+        termids = self.inv_index.get_termids(tokens)
+        if len(termids) < len(tokens):
+            return None
+        return [[termid] for termid in termids]
+
+    @metrics.timed("postings")
+    def resolve_term(self, text: str, lang: str):
+        # Posting lists of the tokens of a boolean query term, a wildcard
+        # being the union of its expansions
+        groups = self.get_term_termids(text, lang)
+        if groups is None:
+            return None
+        return [
+            (
+                self.inv_index.get_posting(group[0])
+                if len(group) == 1
+                else self.inv_index.get_merged_posting(group)
+            )
+            for group in groups
+        ]
+
+    @metrics.timed("traversal")
+    def boolean_query(self, tree, lang="english"):
+        planner = QueryPlanner(
+            lambda text: self.resolve_term(text, lang),
+            self.inv_index.all_docids,
+            self.cover_pairs,
+        )
+        results = planner.evaluate(planner.plan(tree))
+        metrics.observe_postings(planner.postings)
+        return self.prepare_final_result(docids=results)
+
+    @metrics.timed_query("boolean")
+    def query_process_boolean(
+        self, query: str, lang: str = "english", default_op: str = "AND"
+    ):
+        """
+        Process a query with AND, OR, NOT and parentheses, e.g.
+        "(exam OR esame) AND date NOT 2019". Terms without an operator
+        between them are joined with default_op.
+        """
+        tree = QueryParser(default_op).parse(query)
+        if lang == "all":
+            # Detect the language once on the whole query, not per term
+            text = " ".join(
+                word
+                for word in QueryParser.TOKENS.findall(query)
+                if word not in QueryParser.OPERATORS | {"(", ")"}
+            )
+            lang = Preprocessor.detect_language(text) if text else "english"
+        return self.boolean_query(tree, lang)
+
     # Disjunctive processing
     def min_docid(self, postings):
         min_docid = math.inf
@@ -49,6 +207,7 @@ class QueryProcessor:
                 min_docid = min(p.docid(), min_docid)
         return min_docid
 
+    @metrics.timed("traversal")
     def boolean_or(self, postings):
         results = []
         current_docid = self.min_docid(postings)
@@ -58,15 +217,16 @@ class QueryProcessor:
                 if posting.docid() == current_docid:
                     posting.next()
             current_docid = self.min_docid(postings)
+        metrics.observe_postings(postings)
         return self.prepare_final_result(docids=results)
 
+    @metrics.timed_query("or")
     def query_process_or(self, query: str, lang: str = "english"):
-        qtokens = set(Preprocessor.preprocess(query, lang))
-        qtermids = self.inv_index.get_termids(qtokens)
-        postings = self.inv_index.get_postings(qtermids)
+        postings = self.get_query_postings(query, lang)
         return self.boolean_or(postings)
 
     # TAAT Algorithm
+    @metrics.timed("traversal")
     def taat(self, postings, k=10):
         A = defaultdict(float)
         for posting in postings:
@@ -75,22 +235,24 @@ class QueryProcessor:
                 A[current_docid] += posting.score()
                 posting.next()
                 current_docid = posting.docid()
-        top = TopQueue(k)
+        top = TopQueue(k, shared=self.shared_threshold)
         for docid, score in A.items():
             top.insert(docid, score)
         result = sorted(top.queue, reverse=True)
+        metrics.observe_postings(postings)
+        metrics.incr("heap_insertions", top.insertions)
 
         return self.prepare_final_result(scores_docids=result)
 
-    def query_process_taat(self, query, lang="english"):
-        qtokens = set(Preprocessor.preprocess(query, lang))
-        qtermids = self.inv_index.get_termids(qtokens)
-        postings = self.inv_index.get_postings(qtermids)
-        return self.taat(postings)
+    @metrics.timed_query("taat")
+    def query_process_taat(self, query, lang="english", k=10):
+        postings = self.get_query_postings(query, lang)
+        return self.taat(postings, k)
 
     # DAAT Algorithm
+    @metrics.timed("traversal")
     def daat(self, postings, k=10):
-        top = TopQueue(k)
+        top = TopQueue(k, shared=self.shared_threshold)
         current_docid = self.min_docid(postings)
         while current_docid != math.inf:
             score = 0
@@ -100,39 +262,192 @@ class QueryProcessor:
                     score += posting.score()
                     posting.next()
                 if not posting.is_end_list():
-                    next_docid = posting.docid()
+                    next_docid = min(next_docid, posting.docid())
             top.insert(current_docid, score)
             current_docid = next_docid
         result = sorted(top.queue, reverse=True)
+        metrics.observe_postings(postings)
+        metrics.incr("heap_insertions", top.insertions)
+        return self.prepare_final_result(scores_docids=result)
+
+    @metrics.timed_query("daat")
+    def query_process_daat(self, query: str, lang: str = "english", k=10):
+        postings = self.get_query_postings(query, lang)
+        return self.daat(postings, k)
+
+    # Tiered DAAT
+    def get_tier_index(self):
+        if self.tier_index is None:
+            self.tier_index = InvertedIndexManager.load_tier_index(
+                Path(self.index_file).with_name("tier1.pkl")
+            )
+        return self.tier_index
+
+    def exact_score(self, docid, termids):
+        # Score of a document looked up in the full posting lists
+        score = 0.0
+        for termid in termids:
+            docids = self.inv_index.inv["docids"][termid]
+            pos = bisect_left(docids, docid)
+            if pos < len(docids) and docids[pos] == docid:
+                freq = self.inv_index.inv["freqs"][termid][pos]
+                score += freq / self.doc.doclen(docid)
+        return score
+
+    @metrics.timed("traversal")
+    def tiered(self, termids, k=10):
+        # Scores over tier 1 are lower bounds of the true scores. A document
+        # missing from the tier of a term can score at most the bound of that
+        # term, so the top-k of tier 1 is safe when its k-th lower bound is
+        # not beaten by the upper bound of any other document, seen or not
+        tier = self.get_tier_index()
+        self.tier_stats["queries"] += 1
+
+        lower = defaultdict(float)
+        missing = {}  # docid -> sum of the bounds of the terms it misses
+        total_bound = sum(tier.bounds[termid] for termid in termids)
+        for termid in termids:
+            bound = tier.bounds[termid]
+            posting = tier.get_posting(termid, self.doc)
+            while not posting.is_end_list():
+                docid = posting.docid()
+                lower[docid] += posting.score()
+                missing[docid] = missing.get(docid, total_bound) - bound
+                posting.next()
+            metrics.observe_postings([posting])
+
+        top = TopQueue(k)
+        for docid, score in lower.items():
+            top.insert(docid, score)
+        metrics.incr("heap_insertions", top.insertions)
+        candidates = {docid for _, docid in top.queue}
+
+        if total_bound > 0:
+            # Documents not in tier 1 at all can reach total_bound
+            best_other = total_bound
+            for docid, score in lower.items():
+                if docid not in candidates:
+                    best_other = max(best_other, score + missing[docid])
+            if top.size() < k or top.queue[0][0] < best_other:
+                self.tier_stats["fallbacks"] += 1
+                metrics.incr("tier_fallbacks")
+                return self.daat(self.inv_index.get_postings(termids), k)
+
+        result = sorted(
+            (
+                (
+                    self.exact_score(docid, termids)
+                    if missing[docid] > 0
+                    else lower[docid]
+                ),
+                docid,
+            )
+            for docid in candidates
+        )
+        return self.prepare_final_result(scores_docids=result[::-1])
+
+    @metrics.timed_query("tiered")
+    def query_process_tiered(self, query, lang="english", k=10):
+        # Scores are additive so the expansions of a wildcard pattern can be
+        # scored as separate terms
+        groups = self.get_query_termids(query, lang)
+        termids = [termid for group in groups for termid in group]
+        return self.tiered(termids, k)
+
+    def fallback_rate(self):
+        if not self.tier_stats["queries"]:
+            return 0.0
+        return self.tier_stats["fallbacks"] / self.tier_stats["queries"]
+
+    # SAAT Algorithm
+    def get_impact_index(self):
+        if self.impact_index is None:
+            self.impact_index = InvertedIndexManager.load_impact_index(
+                Path(self.index_file).with_name("impact.pkl")
+            )
+        return self.impact_index
+
+    @metrics.timed("traversal")
+    def saat(self, segments, k=10, max_postings=None, max_time=None):
+        # Segments of all query terms are processed from the highest impact
+        # to the lowest, so stopping early on a postings or time budget
+        # (in seconds) keeps the contributions that weigh most in the scores
+        A = defaultdict(int)
+        budget = math.inf if max_postings is None else max_postings
+        deadline = math.inf
+        if max_time is not None:
+            deadline = time.perf_counter() + max_time
+
+        # Long segments are processed in chunks to check the deadline often
+        chunk = 1024
+        processed = 0
+        for impact, docids in segments:
+            start = 0
+            while start < len(docids):
+                if processed >= budget or time.perf_counter() >= deadline:
+                    break
+                size = min(chunk, budget - processed)
+                part = docids[start : start + size]  # noqa
+                for docid in part:
+                    A[docid] += impact
+                processed += len(part)
+                start += len(part)
+            if start < len(docids):
+                break  # Budget exhausted
+
+        impact_index = self.get_impact_index()
+        top = TopQueue(k)
+        for docid, score in A.items():
+            top.insert(docid, score)
+        result = sorted(top.queue, reverse=True)
+        metrics.incr("postings_scanned", processed)
+        metrics.incr("heap_insertions", top.insertions)
+        # Back from quantised impacts to the scale of the other modes
+        result = [(impact_index.to_score(s), docid) for s, docid in result]
         return self.prepare_final_result(scores_docids=result)
 
-    def query_process_daat(self, query: str, lang: str = "english"):
-        qtokens = set(Preprocessor.preprocess(query, lang))
-        qtermids = self.inv_index.get_termids(qtokens)
-        postings = self.inv_index.get_postings(qtermids)
-        return self.daat(postings)
+    @metrics.timed_query("saat")
+    def query_process_saat(
+        self,
+        query: str,
+        lang: str = "english",
+        k: int = 10,
+        max_postings: int = None,
+        max_time: float = None,
+    ):
+        impact_index = self.get_impact_index()
+        # Merge the segments of every term, all sorted by decreasing impact
+        segments = heapq.merge(
+            *(
+                impact_index.get_segments(termid)
+                for group in self.get_query_termids(query, lang)
+                for termid in group
+            ),
+            key=lambda segment: segment[0],
+            reverse=True,
+        )
+        return self.saat(segments, k, max_postings, max_time)
 
+    @metrics.timed("render")
     def prepare_final_result(self, scores_docids=None, docids=None):
 
         final_result = []
-        if docids:
+        if docids is not None:
             for docid in docids:
-                doc = self.doc[docid]
                 final_result.append(
                     {
                         "docid": docid,
-                        "title": doc["title"],
-                        "url": doc["url"],
+                        "title": self.doc.title(docid),
+                        "url": self.doc.url(docid),
                     }
                 )
         else:
             for score, docid in scores_docids:
-                doc = self.doc[docid]
                 final_result.append(
                     {
                         "docid": docid,
-                        "title": doc["title"],
-                        "url": doc["url"],
+                        "title": self.doc.title(docid),
+                        "url": self.doc.url(docid),
                         "score": score,
                     }
                 )
@@ -145,5 +460,5 @@ if __name__ == "__main__":
     input_folder = "./data/index/index_en3/index.pkl"
 
     query_processor = QueryProcessor(input_folder)
-    result = query_processor.query_process_daat("Marco OR MARCELLONI")
+    result = query_processor.query_process_boolean("Marco OR MARCELLONI")
     print(result)
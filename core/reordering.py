@@ -0,0 +1,93 @@
+import math
+from collections import Counter
+from itertools import chain
+
+
+class GraphBisection:
+    """
+    Docid order found by recursive graph bisection (Dhulipala et al.,
+    "Compressing Graphs and Indexes with Recursive Graph Bisection", KDD
+    2016). The documents are split in two halves and documents are swapped
+    between them while the swap lowers the estimated size of the d-gaps of
+    the posting lists, i.e. while it gathers the documents sharing terms in
+    the same half. Each half is then split the same way, down to
+    leaf_size documents.
+
+    The estimated size of a term in a half of n documents where it appears
+    deg times is deg * log2(n / (deg + 1)), the bits of its gaps if they
+    were evenly spread.
+    """
+
+    def __init__(self, iterations=5, leaf_size=16):
+        self.iterations = iterations
+        self.leaf_size = leaf_size
+
+    def order(self, inv_d: dict, docids):
+        """Return the docids of the collection in their new order."""
+        # Terms of every document, leaving out the terms of a single
+        # document which have no gap to make smaller
+        self.doc_terms = {docid: [] for docid in docids}
+        for termid, postings in inv_d.items():
+            if len(postings) > 1:
+                for docid in postings:
+                    self.doc_terms[docid].append(termid)
+        order = self.bisect(list(docids))
+        self.doc_terms = None
+        return order
+
+    def degrees(self, docs):
+        # Number of documents of docs in which every term appears
+        return Counter(chain.from_iterable(map(self.doc_terms.get, docs)))
+
+    @staticmethod
+    def move_gains(degrees, other_degrees, n, other_n):
+        # Gain of the estimated size of every term when one of the documents
+        # it appears in moves from a half of n documents to the other one
+        log2 = math.log2
+        gains = {}
+        for termid, deg in degrees.items():
+            other = other_degrees.get(termid, 0)
+            before = deg * log2(n / (deg + 1))
+            before += other * log2(other_n / (other + 1))
+            after = (deg - 1) * log2(n / deg)
+            after += (other + 1) * log2(other_n / (other + 2))
+            gains[termid] = before - after
+        return gains
+
+    def doc_gains(self, docs, gains):
+        # (gain, docid) of moving every document, by decreasing gain
+        return sorted(
+            (
+                (sum(map(gains.__getitem__, self.doc_terms[docid])), docid)
+                for docid in docs
+            ),
+            reverse=True,
+        )
+
+    def bisect(self, docs):
+        if len(docs) <= self.leaf_size:
+            return docs
+        half = len(docs) // 2
+        left, right = docs[:half], docs[half:]
+        n_left, n_right = len(left), len(right)
+        for _ in range(self.iterations):
+            left_deg = self.degrees(left)
+            right_deg = self.degrees(right)
+            to_right = self.move_gains(left_deg, right_deg, n_left, n_right)
+            to_left = self.move_gains(right_deg, left_deg, n_right, n_left)
+            moving = set()
+            for (left_gain, left_doc), (right_gain, right_doc) in zip(
+                self.doc_gains(left, to_right),
+                self.doc_gains(right, to_left),
+            ):
+                if left_gain + right_gain <= 0:
+                    break
+                moving.update((left_doc, right_doc))
+            if not moving:
+                break
+            # Swap the pairs, keeping the relative order of the others
+            in_left = set(left)
+            new_left = [d for d in docs if (d in in_left) != (d in moving)]
+            new_right = [d for d in docs if (d in in_left) == (d in moving)]
+            left, right = new_left, new_right
+        return self.bisect(left) + self.bisect(right)
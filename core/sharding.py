@@ -0,0 +1,285 @@
+import heapq
+import multiprocessing
+from collections import deque
+from pathlib import Path
+
+from .metrics import metrics
+from .querying import QueryProcessor
+
+# Modes returning the top-k results by score, the others return every
+# matching document in docid order
+RANKED_MODES = {"daat", "taat", "tiered", "saat"}
+
+
+class SharedThreshold:
+    # One slot of a shared array seen as a multiprocessing.Value, the top-k
+    # threshold of one of the queries in flight
+    def __init__(self, thresholds, slot):
+        self.thresholds = thresholds
+        self.slot = slot
+
+    @property
+    def value(self):
+        return self.thresholds[self.slot]
+
+    @value.setter
+    def value(self, value):
+        self.thresholds[self.slot] = value
+
+
+def shard_worker(index_file, connection, thresholds):
+    # Serve the queries sent by the coordinator over the pipe until None,
+    # in the order they were sent
+    try:
+        query_processor = QueryProcessor(index_file)
+    except Exception as error:
+        connection.send(error)  # Raised by the coordinator
+        connection.close()
+        return
+    connection.send("ready")
+    while True:
+        request = connection.recv()
+        if request is None:
+            break
+        query_id, slot, mode, query, lang, k, options, recorded = request
+        # Only the record of this query is sent back, with the results
+        metrics.enabled = recorded
+        metrics.recent.clear()
+        threshold = SharedThreshold(thresholds, slot)
+        query_processor.shared_threshold = threshold
+        process = getattr(query_processor, f"query_process_{mode}")
+        if mode in RANKED_MODES:
+            options = {"k": k, **options}
+        try:
+            result = process(query, lang, **options)
+        except Exception as error:
+            # Sent back to the coordinator, which raises it, so that a bad
+            # query does not stop the worker
+            result = error
+        record = metrics.recent[-1] if metrics.recent else None
+        connection.send((query_id, result, record))
+    connection.close()
+
+
+class ShardedQueryProcessor:
+    """
+    Coordinator of a document-partitioned index built with num_shards > 1.
+    Every shard is served by its own worker process; a query is sent to all
+    of them and their results are merged. Up to max_in_flight queries can
+    be sent before their results are collected (see search_many), so that
+    a shard moves on to the next query instead of waiting for the slowest
+    shard. Every query in flight has its own top-k threshold shared by the
+    shards, which only saves the heap insertions of the documents another
+    shard has already beaten k times: the postings are all scored.
+    """
+
+    def __init__(self, index_folder, max_in_flight=16):
+        index_folder_path = Path(index_folder)
+        shard_files = sorted(
+            index_folder_path.glob("shard_*/index.pkl"),
+            key=lambda path: int(path.parent.name.split("_")[1]),
+        )
+        if len(shard_files) == 0:
+            raise ValueError(
+                f"No shards found in the index folder {index_folder}. \
+                    Build the index with more than one shard."
+            )
+
+        self.max_in_flight = max_in_flight
+        self.thresholds = multiprocessing.Array("d", max_in_flight, lock=False)
+        self.free_slots = list(range(max_in_flight))
+        self.next_id = 0
+        # query_id -> [slot, mode, k, results, metrics records], one
+        # result and record per shard, None until received
+        self.pending = {}
+        self.workers = []
+        for shard_file in shard_files:
+            connection, worker_connection = multiprocessing.Pipe()
+            args = (str(shard_file), worker_connection, self.thresholds)
+            process = multiprocessing.Process(
+                target=shard_worker, args=args, daemon=True
+            )
+            process.start()
+            # Only the worker keeps its end of the pipe open, so that recv
+            # raises EOFError instead of blocking if the worker dies
+            worker_connection.close()
+            self.workers.append((process, connection))
+
+        # Wait for every shard to load its index
+        try:
+            replies = [self.receive(conn) for _, conn in self.workers]
+            for reply in replies:
+                if isinstance(reply, Exception):
+                    raise reply
+        except Exception:
+            self.terminate()
+            raise
+
+    def submit(self, mode, query, lang="english", k=10, **options):
+        """Send a query to every shard and return its id for collect."""
+        if not self.free_slots:
+            raise ValueError(
+                f"Already {self.max_in_flight} queries in flight. \
+                    Collect some of them first."
+            )
+        query_id = self.next_id
+        self.next_id += 1
+        slot = self.free_slots.pop()
+        self.thresholds[slot] = 0.0
+        request = (query_id, slot, mode, query, lang, k, options)
+        self.send_all(request + (metrics.enabled,))
+        n = len(self.workers)
+        self.pending[query_id] = [slot, mode, k, [None] * n, [None] * n]
+        return query_id
+
+    def collect(self, query_id):
+        """Wait for the results of a submitted query and merge them."""
+        slot, mode, k, results, records = self.pending[query_id]
+        for shard, (_, connection) in enumerate(self.workers):
+            # A shard answers in submission order, the replies to the
+            # queries sent before this one are kept until collected
+            while results[shard] is None:
+                reply_id, result, record = self.receive(connection)
+                self.pending[reply_id][3][shard] = result
+                self.pending[reply_id][4][shard] = record
+        del self.pending[query_id]
+        self.free_slots.append(slot)
+        self.observe_shards(records)
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+
+        with metrics.stage("merge"):
+            if mode in RANKED_MODES:
+                return heapq.nlargest(
+                    k,
+                    (result for shard in results for result in shard),
+                    key=lambda result: result["score"],
+                )
+            # Shards hold increasing docid ranges
+            return [result for shard in results for result in shard]
+
+    @staticmethod
+    def observe_shards(records):
+        # Counters of every shard and stages of the slowest one, the one
+        # the query waited for
+        records = [record for record in records if record is not None]
+        if not metrics.enabled or not records:
+            return
+        for record in records:
+            for name, value in record["counters"].items():
+                metrics.incr(name, value)
+        slowest = max(records, key=lambda record: record["seconds"])
+        for name, seconds in slowest["stages"].items():
+            metrics.observe_stage(name, seconds)
+
+    def search(self, mode, query, lang="english", k=10, **options):
+        with metrics.query(mode):
+            query_id = self.submit(mode, query, lang, k, **options)
+            return self.collect(query_id)
+
+    def search_many(self, mode, queries, k=10, **options):
+        """
+        Yield the results of (query, lang) pairs in order, keeping up to
+        max_in_flight queries sent to the shards at any time.
+        """
+        in_flight = deque()
+        try:
+            for query, lang in queries:
+                if len(in_flight) == self.max_in_flight:
+                    yield self.collect(in_flight.popleft())
+                submitted = self.submit(mode, query, lang, k, **options)
+                in_flight.append(submitted)
+            while in_flight:
+                yield self.collect(in_flight.popleft())
+        finally:
+            # Drop the results left after an error or when the caller stops
+            # early, so that their slots are freed
+            for query_id in in_flight:
+                if query_id in self.pending:
+                    try:
+                        self.collect(query_id)
+                    except Exception:
+                        pass
+
+    def send_all(self, request):
+        if not self.workers:
+            raise ValueError(
+                "The shard workers are not running. \
+                    Open the sharded index again."
+            )
+        try:
+            for _, connection in self.workers:
+                connection.send(request)
+        except OSError:
+            self.terminate()  # A worker died
+            raise
+
+    def receive(self, connection):
+        try:
+            return connection.recv()
+        except (EOFError, OSError):
+            # A worker died, the shards left cannot answer a query alone
+            self.terminate()
+            raise
+
+    def query_process_and(self, query: str, lang: str = "english"):
+        return self.search("and", query, lang)
+
+    def query_process_or(self, query: str, lang: str = "english"):
+        return self.search("or", query, lang)
+
+    def query_process_boolean(self, query, lang="english", default_op="AND"):
+        return self.search("boolean", query, lang, default_op=default_op)
+
+    def query_process_taat(self, query, lang="english", k=10):
+        return self.search("taat", query, lang, k)
+
+    def query_process_daat(self, query: str, lang: str = "english", k=10):
+        return self.search("daat", query, lang, k)
+
+    def query_process_tiered(self, query, lang="english", k=10):
+        return self.search("tiered", query, lang, k)
+
+    def query_process_saat(
+        self,
+        query: str,
+        lang: str = "english",
+        k: int = 10,
+        max_postings: int = None,
+        max_time: float = None,
+    ):
+        # Each shard stops on its own budget, the shards run in parallel
+        return self.search(
+            "saat",
+            query,
+            lang,
+            k,
+            max_postings=max_postings,
+            max_time=max_time,
+        )
+
+    def terminate(self):
+        for process, connection in self.workers:
+            process.terminate()
+            process.join()
+            connection.close()
+        self.workers = []
+        self.pending = {}
+        self.free_slots = list(range(self.max_in_flight))
+
+    def close(self):
+        for process, connection in self.workers:
+            try:
+                connection.send(None)
+            except OSError:
+                pass  # The worker is already gone
+            process.join()
+            connection.close()
+        self.workers = []
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
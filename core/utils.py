@@ -6,26 +6,46 @@ import time
 from pathlib import Path
 from typing import List
 
-import nltk
-from langdetect import detect
-from nltk.corpus import stopwords
-from nltk.stem import SnowballStemmer
-from nltk.tokenize import word_tokenize
+from .documents import DocumentTable
+from .lexicon import FrontCodedLexicon
+from .metrics import metrics
+from .models import ImpactIndex, TierIndex
 
-# Download the stopwords
-nltk.download("punkt", quiet=True)
-nltk.download("punkt_tab", quiet=True)
-nltk.download("stopwords", quiet=True)
+# NLTK resources needed by the preprocessor: (resource path, package)
+NLTK_RESOURCES = [
+    ("tokenizers/punkt", "punkt"),
+    ("tokenizers/punkt_tab", "punkt_tab"),
+    ("corpora/stopwords", "stopwords"),
+]
+
+
+def ensure_nltk_resources():
+    # Look the resources up on disk (e.g. vendored in the image through
+    # NLTK_DATA) and only download the missing ones
+    import nltk
+
+    for resource, package in NLTK_RESOURCES:
+        try:
+            nltk.data.find(resource)
+        except LookupError:
+            nltk.download(package, quiet=True)
 
 
 class Preprocessor:
 
+    # Stopwords and stemmer per language, loaded on first use so that nltk
+    # is neither imported nor read from disk until the first text
+    stop_words = {}
+    stemmers = {}
+
     @staticmethod
-    def preprocess(text: str, lang: str = "english") -> List[str]:
+    def load_language(lang: str):
+        if lang in Preprocessor.stemmers:
+            return
 
-        if lang == "all":
-            tmp_lang = detect(text)
-            lang = "english" if tmp_lang == "en" else "italian"
+        ensure_nltk_resources()
+        from nltk.corpus import stopwords
+        from nltk.stem import SnowballStemmer
 
         if lang not in stopwords.fileids():
             raise ValueError(
@@ -33,6 +53,25 @@ class Preprocessor:
                 should be one of the following: {stopwords.fileids()}"
             )
 
+        Preprocessor.stop_words[lang] = set(stopwords.words(lang))
+        Preprocessor.stemmers[lang] = SnowballStemmer(lang)
+
+    @staticmethod
+    def detect_language(text: str) -> str:
+        from langdetect import detect
+
+        return "english" if detect(text) == "en" else "italian"
+
+    @staticmethod
+    @metrics.timed("preprocess")
+    def preprocess(text: str, lang: str = "english") -> List[str]:
+
+        if lang == "all":
+            lang = Preprocessor.detect_language(text)
+
+        Preprocessor.load_language(lang)
+        from nltk.tokenize import word_tokenize
+
         # Lowercase the text
         text = text.lower()
 
@@ -54,17 +93,23 @@ class Preprocessor:
         tokens = word_tokenize(text, language=lang)
 
         # Remove stopwords for the given language
-        stop_words = set(stopwords.words(lang))
+        stop_words = Preprocessor.stop_words[lang]
         tokens = [word for word in tokens if word not in stop_words]
 
         # Stemming
-        stemmer = SnowballStemmer(lang)
+        stemmer = Preprocessor.stemmers[lang]
 
         # Stem the tokens
         tokens = [stemmer.stem(token) for token in tokens]
 
         return tokens
 
+    @staticmethod
+    def stem(word: str, lang: str = "english") -> str:
+        # Stem of a single word as it is, e.g. the prefix of a wildcard
+        Preprocessor.load_language(lang)
+        return Preprocessor.stemmers[lang].stem(word)
+
     @staticmethod
     def profile(f):
         def f_timer(*args, **kwargs):
@@ -109,6 +154,19 @@ class InvertedIndexManager:
         with open(input_file_path, "rb") as f:
             lexicon, inv, doc_index, stats = pickle.load(f)
 
+        # The lexicon is stored apart as a front-coded file and memory
+        # mapped, indexes saved before keep it inside the pickle file
+        if lexicon is None:
+            lexicon_file = input_file_path.with_name("lexicon.bin")
+            lexicon = FrontCodedLexicon.load(lexicon_file)
+
+        # Same for the document table, indexes saved before keep a dict
+        if doc_index is None:
+            doc_file = input_file_path.with_name("documents.bin")
+            doc_index = DocumentTable.load(doc_file)
+        elif isinstance(doc_index, dict):
+            doc_index = DocumentTable.from_dict(doc_index)
+
         return lexicon, inv, doc_index, stats
 
     @staticmethod
@@ -117,14 +175,21 @@ class InvertedIndexManager:
         lexicon: dict,
         inv_d: dict,
         inv_f: dict,
-        doc_index: list,
+        doc_index: DocumentTable,
         stats: dict,
     ):
 
+        # Save the lexicon in compact form, it is loaded from lexicon.bin
+        compact_lexicon = FrontCodedLexicon.build(lexicon)
+        compact_lexicon.save(f"{output_folder_path}/lexicon.bin")
+
+        # Save the document table apart, it is loaded from documents.bin
+        doc_index.save(f"{output_folder_path}/documents.bin")
+
         # Save the results as pickle files
         with open(f"{output_folder_path}/index.pkl", "wb") as f:
             pickle.dump(
-                (lexicon, {"docids": inv_d, "freqs": inv_f}, doc_index, stats),
+                (None, {"docids": inv_d, "freqs": inv_f}, None, stats),
                 f,
             )
 
@@ -142,13 +207,65 @@ class InvertedIndexManager:
         with open(
             f"{output_folder_path}/doc_index.jsonl", "w", encoding="utf-8"
         ) as doc_file:
-            doc_file.write(json.dumps(doc_index, ensure_ascii=False))
+            doc_file.write(json.dumps(doc_index.to_dict(), ensure_ascii=False))
 
         with open(
             f"{output_folder_path}/stats.json", "w", encoding="utf-8"
         ) as stats_file:
             json.dump(stats, stats_file, ensure_ascii=False, indent=4)
 
+    @staticmethod
+    def load_impact_index(input_file: str):
+
+        input_file_path = Path(input_file)
+        if not input_file_path.is_file():
+            raise ValueError(
+                f"Impact index {input_file} does not exist. \
+                    Build the index with the impact-ordered option."
+            )
+
+        with open(input_file_path, "rb") as f:
+            segments, max_score, levels = pickle.load(f)
+
+        return ImpactIndex(segments, max_score, levels)
+
+    @staticmethod
+    def save_impact_index(output_folder_path: Path, impact_index: ImpactIndex):
+
+        with open(f"{output_folder_path}/impact.pkl", "wb") as f:
+            pickle.dump(
+                (
+                    impact_index.segments,
+                    impact_index.max_score,
+                    impact_index.levels,
+                ),
+                f,
+            )
+
+    @staticmethod
+    def load_tier_index(input_file: str):
+
+        input_file_path = Path(input_file)
+        if not input_file_path.is_file():
+            raise ValueError(
+                f"Tier index {input_file} does not exist. \
+                    Build the index with the tier size option."
+            )
+
+        with open(input_file_path, "rb") as f:
+            inv, bounds, tier_size = pickle.load(f)
+
+        return TierIndex(inv, bounds, tier_size)
+
+    @staticmethod
+    def save_tier_index(output_folder_path: Path, tier_index: TierIndex):
+
+        with open(f"{output_folder_path}/tier1.pkl", "wb") as f:
+            pickle.dump(
+                (tier_index.inv, tier_index.bounds, tier_index.tier_size),
+                f,
+            )
+
 
 if __name__ == "__main__":
 